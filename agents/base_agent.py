@@ -39,6 +39,10 @@ class AgentResponse:
 
 
 class BaseAgent(ABC):
+    # Subclasses that declare their own __slots__ get instances without a __dict__;
+    # the rest keep one as usual
+    __slots__ = ("name", "description", "config", "status")
+    
     def __init__(self, name: str, description: str, config: Optional[Dict[str, Any]] = None):
         self.name = name
         self.description = description
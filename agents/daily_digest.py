@@ -1,32 +1,30 @@
 import os
+import re
 import json
 import random
 import csv
+import time
 import mimetypes
-from collections import defaultdict
+import hashlib
+import shelve
+import functools
+import importlib
+import copy
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, Any, Union, List, Optional
+from typing import Dict, Any, Union, List, Optional, Iterator, Iterable
 from pathlib import Path
 
 try:
-    import pandas as pd
+    import orjson
 except ImportError:
-    pd = None
+    orjson = None
 
 try:
-    import docx
+    import ciso8601
 except ImportError:
-    docx = None
-
-try:
-    import pypdf
-except ImportError:
-    pypdf = None
-
-try:
-    from PIL import Image
-except ImportError:
-    Image = None
+    ciso8601 = None
 
 try:
     import google.generativeai as genai
@@ -39,6 +37,97 @@ except ImportError:
     raise ImportError("Install python-dotenv: pip install python-dotenv")
 
 from agents.base_agent import BaseAgent, AgentResponse, AgentStatus
+from agents.gemini_models import get_model as _get_model
+
+_DATE_RE = re.compile(r'^(\d{4}-\d{2}-\d{2})')
+
+@functools.lru_cache(maxsize=None)
+def _optional_module(name: str) -> Any:
+    """
+    Imports a heavyweight optional dependency (pandas, python-docx, pypdf, Pillow)
+    on first use instead of at module import. Returns None if it is not installed.
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_ymd(date_str: str) -> datetime:
+    """Parses a YYYY-MM-DD string, memoized since the same dates recur across runs"""
+    if ciso8601 is not None:
+        return ciso8601.parse_datetime(date_str)
+    return datetime.strptime(date_str, "%Y-%m-%d")
+
+
+@functools.lru_cache(maxsize=None)
+def _trend_kernel() -> Any:
+    """
+    Builds the per-metric trend/volatility kernel on first use (numpy is imported lazily like
+    pandas). JIT-compiled with Numba when it is installed, plain Python loops otherwise.
+    """
+    np = importlib.import_module("numpy")
+    numba = _optional_module("numba")
+    if numba is not None:
+        # No "nnan" fast-math flag: the kernel relies on NaN checks to skip missing values
+        jit = numba.njit(cache=True, parallel=True, fastmath={"reassoc", "contract", "arcp"})
+        prange = numba.prange
+    else:
+        jit = lambda f: f
+        prange = range
+
+    def trend_and_volatility(values):
+        """values is a float64 (dates x metrics) array; returns least-squares slope per date and
+        the standard deviation of step-to-step percentage changes, per metric"""
+        n_rows, n_cols = values.shape
+        slopes = np.full(n_cols, np.nan)
+        volatility = np.full(n_cols, np.nan)
+        for j in prange(n_cols):
+            count = 0
+            sx = sy = sxx = sxy = 0.0
+            steps = 0
+            s_step = ss_step = 0.0
+            prev = np.nan
+            for i in range(n_rows):
+                y = values[i, j]
+                if y != y:  # NaN
+                    continue
+                count += 1
+                sx += i
+                sy += y
+                sxx += i * i
+                sxy += i * y
+                if prev == prev and prev != 0.0:
+                    step = (y - prev) / abs(prev) * 100.0
+                    steps += 1
+                    s_step += step
+                    ss_step += step * step
+                prev = y
+            denom = count * sxx - sx * sx
+            if count >= 2 and denom != 0.0:
+                slopes[j] = (count * sxy - sx * sy) / denom
+            if steps >= 2:
+                mean_step = s_step / steps
+                volatility[j] = np.sqrt(max(ss_step / steps - mean_step * mean_step, 0.0))
+        return slopes, volatility
+
+    return jit(trend_and_volatility)
+
+
+def _json_loads(text: str) -> Any:
+    """Parse JSON with orjson when available, stdlib json otherwise"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _json_dumps_indented(obj: Any) -> str:
+    """Pretty-print JSON with orjson when available, stdlib json otherwise"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, indent=2)
+
 
 class ImageAgent(BaseAgent):
     """
@@ -48,6 +137,71 @@ class ImageAgent(BaseAgent):
     1. Generates a detailed JSON prompt from the user's topic
     2. Uses that prompt to generate an image with Gemini's image generation model
     """
+    PROMPT_MEMO_SIZE = 256
+    
+    # Prebuilt prompt fields for the supported styles; short topics in one of these
+    # styles are expanded locally instead of with a Gemini round-trip
+    _STYLE_TEMPLATES: Dict[str, Dict[str, str]] = {
+        "realistic": {
+            "composition": "rule of thirds, natural perspective",
+            "lighting": "soft natural daylight",
+            "color_palette": "true-to-life, naturally balanced colors",
+            "mood": "authentic and grounded",
+            "technical_details": "photorealistic, 4K, sharp focus, shallow depth of field",
+        },
+        "cartoon": {
+            "composition": "centered subject, bold silhouettes",
+            "lighting": "flat, even lighting with simple cel shading",
+            "color_palette": "bright, saturated primary colors",
+            "mood": "playful and friendly",
+            "technical_details": "clean thick outlines, 2D illustration, high resolution",
+        },
+        "minimalist": {
+            "composition": "centered subject with generous negative space",
+            "lighting": "soft, diffuse lighting",
+            "color_palette": "limited palette of two or three muted tones",
+            "mood": "calm and uncluttered",
+            "technical_details": "simple geometric shapes, crisp edges, vector style",
+        },
+        "watercolor": {
+            "composition": "loose, balanced arrangement with soft edges",
+            "lighting": "gentle, luminous light",
+            "color_palette": "translucent pastel washes",
+            "mood": "dreamy and serene",
+            "technical_details": "visible paper texture, wet-on-wet bleeds, high resolution scan",
+        },
+        "professional": {
+            "composition": "centered, balanced composition",
+            "lighting": "clean studio lighting",
+            "color_palette": "neutral corporate tones with a single accent color",
+            "mood": "polished and trustworthy",
+            "technical_details": "high quality, sharp focus, 4K resolution",
+        },
+        "modern": {
+            "composition": "asymmetric layout with strong lines",
+            "lighting": "bright, high-key lighting",
+            "color_palette": "bold contemporary colors with gradients",
+            "mood": "fresh and dynamic",
+            "technical_details": "sleek rendering, 4K, crisp detail",
+        },
+        "vintage": {
+            "composition": "classic centered framing",
+            "lighting": "warm, nostalgic golden light",
+            "color_palette": "faded sepia and desaturated warm tones",
+            "mood": "nostalgic and timeless",
+            "technical_details": "film grain, slight vignette, retro print texture",
+        },
+        "abstract": {
+            "composition": "dynamic, non-representational arrangement",
+            "lighting": "dramatic contrast",
+            "color_palette": "vivid, contrasting colors",
+            "mood": "expressive and energetic",
+            "technical_details": "layered shapes and textures, high resolution",
+        },
+    }
+    
+    # Deletes every ASCII character that is not alphanumeric, space, dash or underscore
+    _FILENAME_TABLE = str.maketrans({c: None for c in map(chr, range(128)) if not (c.isalnum() or c in ' -_')})
     
     def __init__(self, config: Optional[Dict[str, Any]] = None):
         super().__init__(
@@ -64,14 +218,16 @@ class ImageAgent(BaseAgent):
         self.image_model_name = self.config.get("image_model_name", "gemini-3-pro-image-preview")
         self.save_to_file = self.config.get("save_to_file", True)
         self.output_dir = Path(self.config.get("output_dir", "outputs/images"))
+        self.prompt_cache_path = Path(self.config.get("prompt_cache_path", "outputs/.prompt_cache"))
+        # (topic, style, aspect_ratio) -> parsed prompt; sits in front of the shelve cache
+        self._prompt_memo: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
         
         if self.save_to_file:
             self.output_dir.mkdir(parents=True, exist_ok=True)
         
         if self.api_key:
-            genai.configure(api_key=self.api_key)
-            self.text_model = genai.GenerativeModel(self.text_model_name)
-            self.image_model = genai.GenerativeModel(self.image_model_name)
+            self.text_model = _get_model(self.api_key, self.text_model_name)
+            self.image_model = _get_model(self.api_key, self.image_model_name)
         else:
             self.text_model = None
             self.image_model = None
@@ -152,9 +308,71 @@ class ImageAgent(BaseAgent):
         Returns:
             Dictionary with detailed prompt information
         """
+        template = self._STYLE_TEMPLATES.get(style)
+        if template is not None and len(topic) < 80:
+            prompt_data = dict(template)
+            prompt_data.update({
+                "main_subject": topic,
+                "detailed_description": f"A {style} image of {topic}, {template['mood']} mood, {template['lighting']}",
+                "visual_elements": [topic],
+                "style": style,
+                "aspect_ratio": aspect_ratio,
+                "original_topic": topic,
+            })
+            return prompt_data
+        
         if not self.text_model:
             raise ValueError("Gemini API key required")
         
+        try:
+            return self._cached_detailed_prompt(topic, style, aspect_ratio)
+        except json.JSONDecodeError as e:
+            print(f"[IMAGE AGENT] JSON parsing error: {e}")
+            # Fallback to a basic prompt structure
+            return {
+                "main_subject": topic,
+                "detailed_description": f"A {style} image depicting {topic}",
+                "visual_elements": [topic],
+                "composition": "centered, balanced composition",
+                "lighting": "natural, even lighting",
+                "color_palette": "harmonious and appealing colors",
+                "mood": "professional and polished",
+                "technical_details": "high quality, sharp focus, 4K resolution",
+                "style": style,
+                "aspect_ratio": aspect_ratio,
+                "original_topic": topic,
+            }
+        except Exception as e:
+            print(f"[IMAGE AGENT] Error generating prompt: {e}")
+            raise
+    
+    def _cached_detailed_prompt(self, topic: str, style: str, aspect_ratio: str) -> Dict[str, Any]:
+        """
+        Return the parsed prompt for (topic, style, aspect_ratio), consulting the
+        in-memory LRU first and the on-disk shelve cache second. Only successfully
+        parsed responses are cached; JSON errors propagate to the caller.
+        """
+        memo_key = (topic, style, aspect_ratio)
+        memo = self._prompt_memo.get(memo_key)
+        if memo is not None:
+            self._prompt_memo.move_to_end(memo_key)
+            # Callers add to and edit the prompt dict, so never hand out the memoized one
+            return copy.deepcopy(memo)
+        
+        key = hashlib.md5(f"{topic}|{style}|{aspect_ratio}".encode()).hexdigest()
+        
+        prompt_data = self._read_prompt_cache(key)
+        if prompt_data is None:
+            prompt_data = self._generate_prompt_data(key, topic, style, aspect_ratio)
+        
+        self._prompt_memo[memo_key] = copy.deepcopy(prompt_data)
+        while len(self._prompt_memo) > self.PROMPT_MEMO_SIZE:
+            self._prompt_memo.popitem(last=False)
+        return prompt_data
+    
+    def _generate_prompt_data(self, key: str, topic: str, style: str, aspect_ratio: str) -> Dict[str, Any]:
+        """Asks the text model for a detailed prompt and stores it in the shelve cache under key"""
+        
         system_prompt = """You are an expert image prompt engineer. Your job is to take a simple topic 
 and expand it into a detailed, comprehensive image generation prompt.
 
@@ -177,46 +395,41 @@ Style: {style}
 Aspect Ratio: {aspect_ratio}
 
 Generate a detailed image prompt in JSON format. Be specific about visual details, composition, and atmosphere."""
-
+        
+        response = self.text_model.generate_content(f"{system_prompt}\\n\\n{user_prompt}")
+        response_text = response.text.strip()
+        
+        # Extract JSON from response (handle code blocks)
+        if "```json" in response_text:
+            response_text = response_text.split("```json")[1].split("```")[0].strip()
+        elif "```" in response_text:
+            response_text = response_text.split("```")[1].split("```")[0].strip()
+        
+        prompt_data = _json_loads(response_text)
+        
+        # Add metadata
+        prompt_data["style"] = style
+        prompt_data["aspect_ratio"] = aspect_ratio
+        prompt_data["original_topic"] = topic
+        
+        self._write_prompt_cache(key, prompt_data)
+        return prompt_data
+    
+    def _read_prompt_cache(self, key: str) -> Optional[Dict[str, Any]]:
         try:
-            response = self.text_model.generate_content(f"{system_prompt}\\n\\n{user_prompt}")
-            response_text = response.text.strip()
-            
-            # Extract JSON from response (handle code blocks)
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                response_text = response_text.split("```")[1].split("```")[0].strip()
-            
-            prompt_data = json.loads(response_text)
-            
-            # Add metadata
-            prompt_data["style"] = style
-            prompt_data["aspect_ratio"] = aspect_ratio
-            prompt_data["original_topic"] = topic
-            
-            return prompt_data
-            
-        except json.JSONDecodeError as e:
-            print(f"[IMAGE AGENT] JSON parsing error: {e}")
-            print(f"[IMAGE AGENT] Response text: {response_text}")
-            # Fallback to a basic prompt structure
-            return {
-                "main_subject": topic,
-                "detailed_description": f"A {style} image depicting {topic}",
-                "visual_elements": [topic],
-                "composition": "centered, balanced composition",
-                "lighting": "natural, even lighting",
-                "color_palette": "harmonious and appealing colors",
-                "mood": "professional and polished",
-                "technical_details": "high quality, sharp focus, 4K resolution",
-                "style": style,
-                "aspect_ratio": aspect_ratio,
-                "original_topic": topic,
-            }
+            with shelve.open(str(self.prompt_cache_path), flag="r") as cache:
+                return cache.get(key)
+        except Exception:
+            # Missing or unreadable cache file - treat as a miss
+            return None
+    
+    def _write_prompt_cache(self, key: str, prompt_data: Dict[str, Any]) -> None:
+        try:
+            self.prompt_cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with shelve.open(str(self.prompt_cache_path)) as cache:
+                cache[key] = prompt_data
         except Exception as e:
-            print(f"[IMAGE AGENT] Error generating prompt: {e}")
-            raise
+            print(f"[IMAGE AGENT] Could not persist prompt cache: {e}")
     
     def _generate_image(self, json_prompt: Dict[str, Any], filename: Optional[str]) -> Path:
         """
@@ -245,8 +458,8 @@ Generate a detailed image prompt in JSON format. Be specific about visual detail
             # Save the image
             if filename is None:
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                safe_topic = "".join(c for c in json_prompt["original_topic"][:30] if c.isalnum() or c in (' ', '-', '_')).strip()
-                safe_topic = safe_topic.replace(' ', '_')
+                safe_topic = json_prompt["original_topic"][:30].encode('ascii', 'ignore').decode()
+                safe_topic = safe_topic.translate(self._FILENAME_TABLE).strip().replace(' ', '_')
                 filename = f"image_{safe_topic}_{timestamp}"
             
             image_path = self.output_dir / f"{filename}.png"
@@ -323,6 +536,9 @@ Generate a detailed image prompt in JSON format. Be specific about visual detail
         return base_caps
 
 class DailyDigestSystem:
+    # Above this many dates the summary prompt carries statistics instead of every row
+    FULL_HISTORY_LIMIT = 90
+
     def __init__(self):
         load_dotenv()
         self.api_key = os.getenv("GEMINI_API_KEY")
@@ -330,8 +546,10 @@ class DailyDigestSystem:
             print("Warning: GEMINI_API_KEY not found in environment variables. Please set it in .env file.")
         
         if self.api_key:
-            genai.configure(api_key=self.api_key)
-            self.model = genai.GenerativeModel('gemini-2.0-flash')
+            self.model = _get_model(self.api_key, 'gemini-2.0-flash')
+        
+        # Registry of files already uploaded to the Gemini File API, keyed by content hash
+        self.file_handles_path = Path("outputs/.file_handles.json")
         
         # Initialize the Image Agent
         self.image_agent = ImageAgent()
@@ -368,51 +586,83 @@ class DailyDigestSystem:
             print("No valid files found. Falling back to mock data.")
             return self._get_mock_data()
 
-        aggregated_data = defaultdict(dict)
-        all_dates = set()
+        file_results = []  # date -> metrics per file, in input order
+        gemini_batch = []  # (position in file_results, content, content_type)
 
         for file_path in valid_paths:
             ext = os.path.splitext(file_path)[1].lower()
             print(f"[DIGEST SYSTEM] Processing file: {file_path} ({ext})")
             
-            file_data = {}
             if ext == '.csv':
-                file_data = self._get_raw_data_from_csv(file_path)
+                file_results.append(self._get_raw_data_from_csv(file_path))
             elif ext in ['.xlsx', '.xls']:
-                file_data = self._get_raw_data_from_excel(file_path)
-            elif ext == '.docx':
-                struct = self._get_data_from_docx(file_path)
-                file_data = self._unpack_struct(struct)
-            elif ext == '.pdf':
-                struct = self._get_data_from_pdf(file_path)
-                file_data = self._unpack_struct(struct)
-            elif ext in ['.png', '.jpg', '.jpeg', '.webp']:
-                struct = self._get_data_from_image(file_path)
-                file_data = self._unpack_struct(struct)
+                file_results.append(self._get_raw_data_from_excel(file_path))
+            elif ext in ['.docx', '.pdf', '.png', '.jpg', '.jpeg', '.webp']:
+                # Gemini-backed formats are collected and extracted in one request below
+                loaded = self._load_gemini_content(file_path, ext)
+                if loaded is None:
+                    file_results.append(self._unpack_struct(self._get_mock_data()))
+                else:
+                    gemini_batch.append((len(file_results), *loaded))
+                    file_results.append({})
             else:
                 print(f"Unsupported file extension: {ext}. Skipping.")
                 continue
-            
-        if file_data:
-                for date, metrics in file_data.items():
-                    # Normalize dates to YYYY-MM-DD format for consistent comparison
-                    normalized_date = self._normalize_date(date)
-                    aggregated_data[normalized_date].update(metrics)
-                    all_dates.add(normalized_date)
-        
-        if not all_dates:
+        
+        if gemini_batch:
+            structs = self._extract_metrics_batch([(content, content_type) for _, content, content_type in gemini_batch])
+            for (position, _, _), struct in zip(gemini_batch, structs):
+                file_results[position] = self._unpack_struct(struct)
+        
+        # Flatten into parallel date/metric/value columns, pivoted once below
+        dates, metric_names, values = [], [], []
+        for file_data in file_results:
+            for date, metrics in file_data.items():
+                # Normalize dates to YYYY-MM-DD format for consistent comparison
+                normalized_date = self._normalize_date(date)
+                for metric, value in metrics.items():
+                    dates.append(normalized_date)
+                    metric_names.append(metric)
+                    values.append(value)
+        
+        aggregated_data = self._pivot_metrics(dates, metric_names, values)
+        if not aggregated_data:
             return self._get_mock_data()
 
-        return self._process_dates(all_dates, aggregated_data)
+        return self._process_dates(aggregated_data.keys(), aggregated_data)
+
+    def _pivot_metrics(self, dates: List[str], metric_names: List[str], values: List[Any]) -> Dict[str, Dict[str, Any]]:
+        """
+        Pivots parallel date/metric/value lists into a date->metrics map, ordered by date.
+        Later entries win when the same metric appears twice for a date.
+        """
+        pd = _optional_module("pandas")
+        if not pd or not dates:
+            # Keep dates ordered on insert when sortedcontainers is available
+            sortedcontainers = _optional_module("sortedcontainers")
+            aggregated_data = sortedcontainers.SortedDict() if sortedcontainers else {}
+            for date, metric, value in zip(dates, metric_names, values):
+                aggregated_data.setdefault(date, {})[metric] = value
+            if sortedcontainers:
+                return dict(aggregated_data)
+            return dict(sorted(aggregated_data.items()))
+        
+        df = pd.DataFrame({'date': dates, 'metric': metric_names, 'value': values})
+        df = df.drop_duplicates(['date', 'metric'], keep='last')
+        pivot = df.pivot(index='date', columns='metric', values='value').sort_index()
+        return {date: row.dropna().to_dict() for date, row in pivot.iterrows()}
 
     def _normalize_date(self, date_str: str) -> str:
         """Normalize various date formats to YYYY-MM-DD"""
-        # If already in YYYY-MM-DD format, return as-is
-        if isinstance(date_str, str) and len(date_str) == 10 and date_str[4] == '-' and date_str[7] == '-':
-            return date_str
+        s = date_str if isinstance(date_str, str) else str(date_str)
+        
+        # YYYY-MM-DD, optionally followed by a timestamp
+        m = _DATE_RE.match(s)
+        if m:
+            return m.group(1)
         
         # Otherwise, just return the string (Gemini will handle it)
-        return str(date_str).split()[0]  # Remove timestamp if present
+        return s.split(None, 1)[0]  # Remove timestamp if present
 
     def _unpack_struct(self, struct: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
         """Unpacks the yesterday/today structure back into date->metrics map"""
@@ -455,6 +705,7 @@ class DailyDigestSystem:
         return data_by_date
 
     def _get_raw_data_from_excel(self, file_path: str) -> Dict[str, Dict[str, Any]]:
+        pd = _optional_module("pandas")
         if not pd:
             print("Pandas not installed.")
             return {}
@@ -484,10 +735,26 @@ class DailyDigestSystem:
             print(f"Error reading Excel: {e}")
             return {}
 
-    def _get_data_from_docx(self, file_path: str) -> Dict[str, Any]:
+    def _load_gemini_content(self, file_path: str, ext: str) -> Optional[tuple]:
+        """
+        Reads a docx/pdf/image file into something Gemini can consume.
+        Returns (content, content_type), or None if the file could not be read.
+        """
+        if ext == '.docx':
+            content, content_type = self._read_docx_text(file_path), "text"
+        elif ext == '.pdf':
+            content, content_type = self._read_pdf_text(file_path), "text"
+        else:
+            content, content_type = self._load_image_content(file_path), "image"
+        if content is None:
+            return None
+        return content, content_type
+
+    def _read_docx_text(self, file_path: str) -> Optional[str]:
+        docx = _optional_module("docx")
         if not docx:
             print("python-docx not installed.")
-            return self._get_mock_data()
+            return None
             
         try:
             doc = docx.Document(file_path)
@@ -496,24 +763,22 @@ class DailyDigestSystem:
             for table in doc.tables:
                 for row in table.rows:
                     full_text += "\n" + " | ".join([cell.text for cell in row.cells])
-            
-            return self._extract_metrics_with_gemini(full_text, "text")
+            return full_text
         except Exception as e:
             print(f"Error reading Docx: {e}")
-            return self._get_mock_data()
+            return None
 
-    def _get_data_from_pdf(self, file_path: str) -> Dict[str, Any]:
+    def _read_pdf_text(self, file_path: str) -> Optional[str]:
         # Try using Gemini Multimodal first if file is small enough, 
         # otherwise extract text with pypdf
         
         # Option 1: Extract text
+        pypdf = _optional_module("pypdf")
         if pypdf:
             try:
                 reader = pypdf.PdfReader(file_path)
-                text = ""
-                for page in reader.pages:
-                    text += page.extract_text() + "\n"
-                return self._extract_metrics_with_gemini(text, "text")
+                parts = [page.extract_text() for page in reader.pages]
+                return "\n".join(filter(None, parts))
             except Exception as e:
                 print(f"Error reading PDF with pypdf: {e}")
         
@@ -522,19 +787,64 @@ class DailyDigestSystem:
         # But for simplicity, let's stick to text extraction for PDF for now, 
         # or convert to image if we had pdf2image (which requires poppler).
         
-        return self._get_mock_data()
+        return None
 
-    def _get_data_from_image(self, file_path: str) -> Dict[str, Any]:
+    def _load_image_content(self, file_path: str) -> Any:
+        # Prefer a File API handle so the bytes are uploaded at most once per content
+        try:
+            return self._get_uploaded_file(file_path)
+        except Exception as e:
+            print(f"Error uploading Image, sending inline instead: {e}")
+        
+        Image = _optional_module("PIL.Image")
         if not Image:
             print("Pillow not installed.")
-            return self._get_mock_data()
+            return None
             
         try:
-            img = Image.open(file_path)
-            return self._extract_metrics_with_gemini(img, "image")
+            return Image.open(file_path)
         except Exception as e:
             print(f"Error reading Image: {e}")
-            return self._get_mock_data()
+            return None
+
+    def _get_uploaded_file(self, file_path: str) -> Dict[str, Any]:
+        """
+        Uploads the file to the Gemini File API unless identical content was uploaded
+        before and its handle has not expired. Returns a file_data content part.
+        """
+        with open(file_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        
+        registry = self._load_file_handles()
+        entry = registry.get(digest)
+        if not entry or entry.get("expires", 0) <= time.time():
+            mime_type = mimetypes.guess_type(file_path)[0]
+            uploaded = genai.upload_file(path=file_path, mime_type=mime_type)
+            entry = {
+                "uri": uploaded.uri,
+                "mime_type": uploaded.mime_type,
+                # Uploaded files are kept for 48 hours; leave a safety margin
+                "expires": time.time() + 47 * 3600,
+            }
+            registry[digest] = entry
+            self._save_file_handles(registry)
+        
+        return {"file_data": {"mime_type": entry["mime_type"], "file_uri": entry["uri"]}}
+
+    def _load_file_handles(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.file_handles_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_file_handles(self, registry: Dict[str, Dict[str, Any]]) -> None:
+        try:
+            self.file_handles_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.file_handles_path, 'w', encoding='utf-8') as f:
+                json.dump(registry, f)
+        except OSError as e:
+            print(f"Warning: could not save file handle registry: {e}")
 
     def _extract_metrics_with_gemini(self, content: Any, content_type: str) -> Dict[str, Any]:
         print(f"[DIGEST SYSTEM] Extracting metrics from {content_type} using Gemini...")
@@ -559,18 +869,69 @@ class DailyDigestSystem:
         
         try:
             response = self.model.generate_content([prompt, content])
-            text = response.text.strip()
-            # Clean up markdown
-            if "```json" in text:
-                text = text.split("```json")[1].split("```")[0]
-            elif "```" in text:
-                text = text.split("```")[1].split("```")[0]
-                
-            return json.loads(text)
+            return _json_loads(self._strip_json_fence(response.text.strip()))
         except Exception as e:
             print(f"Error extracting with Gemini: {e}")
             return self._get_mock_data()
 
+    def _extract_metrics_batch(self, contents: List[tuple]) -> List[Dict[str, Any]]:
+        """
+        Extracts metrics from several (content, content_type) items with a single
+        multi-part Gemini request. Falls back to one request per item if the
+        batched response cannot be parsed.
+        """
+        if len(contents) == 1:
+            return [self._extract_metrics_with_gemini(*contents[0])]
+        
+        print(f"[DIGEST SYSTEM] Extracting metrics from {len(contents)} files in one Gemini request...")
+        
+        prompt = f"""
+        Extract business metrics from each of the {len(contents)} files below.
+        Each file is preceded by a "FILE <index>:" marker.
+        For each file, identify data for the two most recent dates available.
+        
+        Return ONLY a JSON object with this exact structure, one entry per file:
+        {{
+            "files": [
+                {{
+                    "index": 0,
+                    "yesterday": {{
+                        "date": "YYYY-MM-DD",
+                        "metrics": {{ "metric_name": value, ... }}
+                    }},
+                    "today": {{
+                        "date": "YYYY-MM-DD",
+                        "metrics": {{ "metric_name": value, ... }}
+                    }}
+                }},
+                ...
+            ]
+        }}
+        If exact dates aren't clear, infer "yesterday" and "today" as the two comparison points.
+        """
+        
+        parts = [prompt]
+        for index, (content, _) in enumerate(contents):
+            parts.append(f"FILE {index}:")
+            parts.append(content)
+        
+        try:
+            response = self.model.generate_content(parts)
+            results = _json_loads(self._strip_json_fence(response.text.strip()))["files"]
+            by_index = {int(result["index"]): result for result in results}
+            return [by_index[index] for index in range(len(contents))]
+        except Exception as e:
+            print(f"Batch extraction failed ({e}), falling back to per-file requests")
+            return [self._extract_metrics_with_gemini(content, content_type) for content, content_type in contents]
+
+    def _strip_json_fence(self, text: str) -> str:
+        """Removes a markdown code fence around a JSON payload"""
+        if "```json" in text:
+            return text.split("```json")[1].split("```")[0]
+        elif "```" in text:
+            return text.split("```")[1].split("```")[0]
+        return text
+
     def _detect_time_span(self, sorted_dates: List[str]) -> str:
         """
         Detect the time span covered by the data.
@@ -580,8 +941,8 @@ class DailyDigestSystem:
             return "days"
         
         try:
-            first_date = datetime.strptime(sorted_dates[0], "%Y-%m-%d")
-            last_date = datetime.strptime(sorted_dates[-1], "%Y-%m-%d")
+            first_date = _parse_ymd(sorted_dates[0])
+            last_date = _parse_ymd(sorted_dates[-1])
             delta = (last_date - first_date).days
             
             if delta <= 7:
@@ -595,12 +956,14 @@ class DailyDigestSystem:
         except:
             return "days"
 
-    def _process_dates(self, all_dates, data_by_date):
+    def _process_dates(self, all_dates: Iterable[str], data_by_date: Dict[str, Dict[str, Any]]):
         """
         Process dates intelligently based on time span.
+        all_dates is an iterable of unique YYYY-MM-DD strings already in ascending order
+        (e.g. the keys of the map returned by _pivot_metrics).
         Returns full historical data for analysis, not just 2 points.
         """
-        sorted_dates = sorted(list(all_dates))
+        sorted_dates = list(all_dates)
         
         if len(sorted_dates) < 2:
             print("Not enough data points to compare. Need at least 2 days.")
@@ -644,7 +1007,37 @@ class DailyDigestSystem:
         
         return data
 
-    def generate_comparison_summary(self, data: Dict[str, Any]) -> str:
+    def _metrics_frame(self, data: Dict[str, Any]) -> Any:
+        """
+        Converts the digest data once into a date x metric DataFrame of numbers, shared by the
+        summary and the visual report. Returns None if pandas is not installed.
+        """
+        pd = _optional_module("pandas")
+        if not pd:
+            return None
+        
+        if "historical_data" in data:
+            rows = data["historical_data"]
+        else:
+            rows = {
+                data[day]["date"]: data[day].get("metrics", {})
+                for day in ("yesterday", "today") if day in data
+            }
+        frame = pd.DataFrame.from_dict(rows, orient="index")
+        return frame.apply(pd.to_numeric, errors="coerce")
+
+    def _summary_stats(self, frame: Any) -> str:
+        """Per-metric min/max/mean, start/end/change, trend slope and volatility, computed column-wise"""
+        stats = frame.agg(["min", "max", "mean"]).T
+        stats["start"] = frame.bfill().iloc[0]
+        stats["end"] = frame.ffill().iloc[-1]
+        stats["change_pct"] = (stats["end"] - stats["start"]) / stats["start"].abs() * 100
+        slopes, volatility = _trend_kernel()(frame.to_numpy(dtype="float64"))
+        stats["trend_per_period"] = slopes
+        stats["volatility_pct"] = volatility
+        return stats.round(2).to_string()
+
+    def generate_comparison_summary(self, data: Dict[str, Any], frame: Any = None) -> str:
         """
         Uses Gemini to analyze the data intelligently.
         Handles both short-term comparisons (2 days) and long-term trends (weeks/months/years).
@@ -653,12 +1046,40 @@ class DailyDigestSystem:
         if not self.api_key:
             return "Error: No API Key provided. Cannot generate summary."
 
+        # One request: this caller needs the whole text, so streaming would only add overhead
+        try:
+            response = self.model.generate_content(self._build_summary_prompt(data, frame))
+            return response.text.strip()
+        except Exception as e:
+            return f"Error generating summary: {str(e)}"
+
+    def stream_comparison_summary(self, data: Dict[str, Any], frame: Any = None) -> Iterator[str]:
+        """
+        Streams the Gemini analysis of the data chunk by chunk as it arrives,
+        for callers that render or forward the summary before it is complete.
+        """
+        if not self.api_key:
+            raise ValueError("No API Key provided. Cannot generate summary.")
+
+        response = self.model.generate_content(self._build_summary_prompt(data, frame), stream=True)
+        for chunk in response:
+            yield chunk.text
+
+    def _build_summary_prompt(self, data: Dict[str, Any], frame: Any = None) -> str:
         date_range = data.get('date_range', {})
         start_date = date_range.get('start', 'unknown')
         end_date = date_range.get('end', 'unknown')
         time_span = data.get('time_span', 'unknown')
         data_points = data.get('data_points', 'unknown')
-        historical = json.dumps(data.get('historical_data', {}), indent=2)
+        
+        if frame is None:
+            frame = self._metrics_frame(data)
+        if frame is not None and len(frame) > self.FULL_HISTORY_LIMIT:
+            # Long series: send the precomputed statistics instead of every row
+            historical = f"(omitted, {len(frame)} rows; see Summary Statistics)"
+        else:
+            historical = _json_dumps_indented(data.get('historical_data', {}))
+        stats = self._summary_stats(frame) if frame is not None and not frame.empty else "unavailable"
 
         prompt = f"""
         You are an expert data analyst. Analyze the following dataset and provide insights.
@@ -668,6 +1089,8 @@ class DailyDigestSystem:
         - Data Points: {data_points}
         - Date Range: {start_date} to {end_date}
         - Full Historical Data: {historical}
+        - Summary Statistics (per metric):
+{stats}
         
         YOUR TASK:
         1. **Identify what this data is about** - What business area/domain does it represent? (e.g., e-commerce, SaaS, operations, user engagement, etc.)
@@ -692,18 +1115,15 @@ class DailyDigestSystem:
 
         Remember: Do NOT assume specific metric names. Analyze whatever is present. Be flexible with the data structure.
         """
-        
-        try:
-            response = self.model.generate_content(prompt)
-            return response.text.strip()
-        except Exception as e:
-            return f"Error generating summary: {str(e)}"
+        return prompt
 
-    def create_visual_report(self, summary: str, data: Dict[str, Any]) -> str:
+    def create_visual_report(self, summary: Optional[str], data: Dict[str, Any], *, frame: Any = None) -> str:
         """
         Uses the ImageAgent to create a visual representation appropriate for the time span.
         For short periods: bar charts
         For longer periods: line charts showing trends
+        The prompt depends only on the data, so this can run alongside the summary;
+        summary is accepted for existing callers but no longer used.
         """
         print("\n[DIGEST SYSTEM] Generating visual report...")
         
@@ -724,8 +1144,10 @@ class DailyDigestSystem:
             viz_type = "line chart with area fill"
             description = "long-term trend analysis"
         
+        metric_names = [str(name) for name in frame.columns] if frame is not None else self._metric_names(data)
+        
         request = {
-            "topic": f"A professional {viz_type} visualization showing {description} from {date_range.get('start')} to {date_range.get('end')}. Metrics: {summary[:200]}...",
+            "topic": f"A professional {viz_type} visualization showing {description} from {date_range.get('start')} to {date_range.get('end')}. Metrics: {', '.join(metric_names)}",
             "style": f"infographic, data visualization, {viz_type}, professional, clean, 2d vector art, business intelligence",
             "aspect_ratio": "16:9",
             "filename": f"report_{data.get('time_span', 'data')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
@@ -738,6 +1160,18 @@ class DailyDigestSystem:
         else:
             raise Exception(f"Image generation failed: {response.error}")
 
+    def _metric_names(self, data: Dict[str, Any]) -> List[str]:
+        """Collects the metric names present in either the historical or the mock data layout"""
+        if "historical_data" in data:
+            rows = data["historical_data"].values()
+        else:
+            rows = [data.get(day, {}).get("metrics", {}) for day in ("yesterday", "today")]
+        
+        names = {}
+        for metrics in rows:
+            names.update(dict.fromkeys(metrics))
+        return [str(name) for name in names]
+
     def run(self, file_paths: Union[str, List[str], None] = None):
         print("[DIGEST SYSTEM] Starting Intelligent Data Analysis...")
         
@@ -753,23 +1187,36 @@ class DailyDigestSystem:
         print(f"[DIGEST SYSTEM] Date range: {date_range.get('start')} to {date_range.get('end')}")
         print(f"[DIGEST SYSTEM] Raw Data: {json.dumps(data, indent=2)}")
         
-        # 2. Generate Text Summary (Let Gemini decide what the data is about)
+        # 2. Generate Text Summary (Let Gemini decide what the data is about) and
+        # 3. Generate Appropriate Visual - concurrently, since the image prompt
+        #    only needs the date range and metric names, not the summary text
         print("\n[DIGEST SYSTEM] Analyzing data with Gemini...")
-        summary = self.generate_comparison_summary(data)
-        print("\n--- DATA ANALYSIS REPORT ---")
-        print(summary)
-        print("----------------------------\n")
-        
-        # 3. Generate Appropriate Visual
-        if not summary.startswith("Error"):
+        # Columnar view built once and shared by both consumers
+        frame = self._metrics_frame(data)
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            summary_future = executor.submit(self.generate_comparison_summary, data, frame)
+            image_future = executor.submit(self.create_visual_report, None, data, frame=frame)
+            
+            summary = summary_future.result()
+            print("\n--- DATA ANALYSIS REPORT ---")
+            print(summary)
+            print("----------------------------\n")
+            
+            if summary.startswith("Error"):
+                # Cancelled if it hasn't started yet; a render already underway is discarded
+                image_future.cancel()
+                print("[DIGEST SYSTEM] Skipping image generation due to analysis error.")
+                return
+            
             try:
-                image_path = self.create_visual_report(summary, data)
+                image_path = image_future.result()
                 print(f"[DIGEST SYSTEM] Visual report generated: {image_path}")
                 print(f"\n✓ Text Summary + Visual Report completed successfully!")
             except Exception as e:
                 print(f"[DIGEST SYSTEM] Failed to generate visual report: {e}")
-        else:
-            print("[DIGEST SYSTEM] Skipping image generation due to analysis error.")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
 import argparse
 
@@ -1,19 +1,44 @@
 from __future__ import annotations
 
 import os
+import re
+import json
+import time
+import functools
+import asyncio
+import tempfile
 from typing import Any, Dict, Optional, List
 from pathlib import Path
 from datetime import datetime
 
 from agents.base_agent import BaseAgent, AgentResponse, AgentStatus
+from agents.gemini_models import get_model, run_shared, run_sync, submit
+from agents.response_cache import ResponseCache
 
 try:
     import google.generativeai as genai
 except ImportError:
     raise ImportError("Install google-genai: pip install google-genai")
 
+try:
+    from rapidfuzz import fuzz
+except ImportError:
+    fuzz = None
+
+_EXT_MAP = {"markdown": "md", "md": "md", "html": "html", "text": "txt", "txt": "txt"}
+_HEADING_RE = re.compile(r'^#{1,6}[ \t]+(.+?)[ \t#]*$', re.MULTILINE)
+
 
 class DocumentAgent(BaseAgent):
+    LENGTH_GUIDANCE = {
+        "short": "500-800 words total",
+        "medium": "1200-2000 words total",
+        "long": "2500-4000 words total"
+    }
+    RESPONSE_CACHE_TTL = ResponseCache.DEFAULT_MAX_AGE  # seconds a cached outline or draft is reused
+    SPECULATION_TTL = 600  # seconds an unclaimed speculative expansion is kept
+    SECTION_MATCH_THRESHOLD = 85  # fuzzy score for a change request to target a section heading
+    
     def __init__(self, config: Optional[Dict[str, Any]] = None):
         super().__init__(
             name="Document Agent",
@@ -25,12 +50,19 @@ class DocumentAgent(BaseAgent):
         if not self.api_key:
             raise ValueError("GEMINI_API_KEY not found in config or environment")
         
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel("gemini-2.0-flash-exp")
+        self.model_name = self.config.get("model_name", "gemini-2.0-flash-exp")
         
         self.output_dir = Path(self.config.get("output_dir", "outputs/documents"))
         self.output_dir.mkdir(parents=True, exist_ok=True)
         
+        # Opt-in: expand every generated outline in the background while the user reviews it.
+        # Costs one extra generation per outline that is edited or never expanded.
+        self.speculative_expansion = self.config.get("speculative_expansion", False)
+        self._speculations: Dict[str, tuple] = {}  # key -> (Future, monotonic start time)
+        
+        # Finished drafts/outlines, so retrying the same request skips Gemini
+        self.response_cache = ResponseCache(self.config.get("response_cache_path", "outputs/.response_cache.sqlite3"))
+        
         self.document_templates = {
             "report": {
                 "sections": ["Executive Summary", "Introduction", "Methodology", "Findings", "Analysis", "Conclusion", "Recommendations"],
@@ -57,21 +89,59 @@ class DocumentAgent(BaseAgent):
                 "tone": "informative and balanced"
             }
         }
+        
+        # Prompt-ready "- Section" lists for each template, built once
+        self._section_blocks = {
+            doc_type: self._format_sections(template["sections"])
+            for doc_type, template in self.document_templates.items()
+        }
+        # (doc_type, format, length) -> static draft instructions
+        self._draft_prefixes: Dict[tuple, str] = {}
+    
+    @functools.cached_property
+    def model(self) -> "genai.GenerativeModel":
+        # Built on first generation and shared with other agents using the same key/model
+        return get_model(self.api_key, self.model_name)
     
     def process(self, request: Dict[str, Any]) -> AgentResponse:
+        return run_sync(self._process_async(request))
+    
+    def process_batch(self, requests: List[Dict[str, Any]]) -> List[AgentResponse]:
+        """Runs several requests concurrently so their Gemini calls overlap"""
+        async def _gather():
+            writes: List[tuple] = []
+            responses = await asyncio.gather(*[self._dispatch(r, writes) for r in requests])
+            # Every generated file is written in one batch once all requests are done
+            await self._flush_writes(writes)
+            return responses
+        return list(run_sync(_gather()))
+    
+    async def aprocess(self, request: Dict[str, Any]) -> AgentResponse:
+        """Awaitable from any event loop; the Gemini calls still run on the shared model loop"""
+        return await run_shared(self._process_async(request))
+    
+    async def _process_async(self, request: Dict[str, Any]) -> AgentResponse:
+        # Per call, so concurrent requests on the shared loop never flush each other's files
+        writes: List[tuple] = []
+        response = await self._dispatch(request, writes)
+        await self._flush_writes(writes)
+        return response
+    
+    async def _dispatch(self, request: Dict[str, Any], writes: List[tuple]) -> AgentResponse:
+        """Runs one request; (path, content) pairs it produces are appended to writes for _flush_writes"""
         self.status = AgentStatus.PROCESSING
         
         try:
             action = request.get("action", "draft")
             
             if action == "draft":
-                return self._draft_document(request)
+                return await self._draft_document(request, writes)
             elif action == "outline":
-                return self._generate_outline(request)
+                return await self._generate_outline(request)
             elif action == "expand_outline":
-                return self._expand_outline(request)
+                return await self._expand_outline(request, writes)
             elif action == "refine":
-                return self._refine_document(request)
+                return await self._refine_document(request, writes)
             else:
                 raise ValueError(f"Unknown action: {action}")
                 
@@ -85,13 +155,13 @@ class DocumentAgent(BaseAgent):
                 metadata={"action": request.get("action", "unknown")}
             )
     
-    def _draft_document(self, request: Dict[str, Any]) -> AgentResponse:
+    async def _draft_document(self, request: Dict[str, Any], writes: List[tuple]) -> AgentResponse:
         self.validate_request(request, ["topic", "document_type"])
         
         topic = request["topic"]
         doc_type = request["document_type"]
         tone = request.get("tone", "professional")
-        format_type = request.get("format", "markdown")
+        format_type = request.get("format", "markdown").lower()
         length = request.get("length", "medium")
         outline = request.get("outline")
         additional_info = request.get("additional_info", "")
@@ -105,52 +175,35 @@ class DocumentAgent(BaseAgent):
         else:
             sections = outline if outline else ["Introduction", "Main Content", "Conclusion"]
         
-        length_guidance = {
-            "short": "500-800 words total",
-            "medium": "1200-2000 words total",
-            "long": "2500-4000 words total"
-        }
+        if not outline and doc_type in self._section_blocks:
+            section_block = self._section_blocks[doc_type]
+        else:
+            section_block = self._format_sections(sections)
         
-        prompt = f"""You are an expert document writer. Create a {doc_type} on: {topic}
-
-DOCUMENT REQUIREMENTS:
-- Type: {doc_type}
-- Tone: {tone}
-- Length: {length_guidance.get(length, length_guidance['medium'])}
-- Format: {format_type}
-
-SECTIONS TO INCLUDE:
-{self._format_sections(sections)}
-
-{additional_info}
-
-INSTRUCTIONS:
-1. Write a comprehensive, well-structured {doc_type}
-2. Use {tone} tone throughout
-3. Follow the section structure provided
-4. Include relevant details, examples, and analysis
-5. Make it engaging and informative
-6. Ensure smooth transitions between sections
-
-OUTPUT FORMAT:
-- Use {format_type} formatting
-- Include proper headings and structure
-- Use markdown syntax if format is markdown
-- Use HTML tags if format is HTML
-- Use plain text with clear section breaks if format is text
+        # Variable parts only; the instruction scaffolding lives in the cached prefix
+        dynamic_suffix = f"""<topic>{topic}</topic>
+<tone>{tone}</tone>
+<sections>
+{section_block}
+</sections>
+<additional_info>{additional_info}</additional_info>
 
 Generate the complete document now:"""
         
         try:
-            response = self.model.generate_content(prompt)
-            document_content = response.text.strip()
-            
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             filename = f"document_{timestamp}.{self._get_file_extension(format_type)}"
             file_path = self.output_dir / filename
             
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(document_content)
+            cache_key = ResponseCache.key("draft", doc_type, topic, tone, format_type, length, sections, additional_info)
+            document_content = self.response_cache.get(cache_key, max_age=self.RESPONSE_CACHE_TTL)
+            streamed = document_content is None
+            if streamed:
+                # Chunks are written to file_path as they arrive
+                document_content = await self._generate_with_prefix(doc_type, format_type, length, dynamic_suffix, file_path)
+                self.response_cache.put(cache_key, document_content, "draft")
+            else:
+                writes.append((file_path, document_content))
             
             self.status = AgentStatus.SUCCESS
             return AgentResponse(
@@ -170,13 +223,14 @@ Generate the complete document now:"""
                     "topic": topic,
                     "document_type": doc_type,
                     "format": format_type,
-                    "length": length
+                    "length": length,
+                    "streamed": streamed
                 }
             )
         except Exception as e:
             raise Exception(f"Error generating document: {str(e)}")
     
-    def _generate_outline(self, request: Dict[str, Any]) -> AgentResponse:
+    async def _generate_outline(self, request: Dict[str, Any]) -> AgentResponse:
         self.validate_request(request, ["topic", "document_type"])
         
         topic = request["topic"]
@@ -217,16 +271,25 @@ Format as JSON:
 Return ONLY valid JSON, no markdown, no explanations."""
         
         try:
-            response = self.model.generate_content(prompt)
-            text = response.text.strip()
-            
-            if text.startswith('```json'):
-                text = text.replace('```json', '').replace('```', '').strip()
-            elif text.startswith('```'):
-                text = text.replace('```', '').strip()
+            cache_key = ResponseCache.key("outline", doc_type, topic, sections)
+            text = self.response_cache.get(cache_key, max_age=self.RESPONSE_CACHE_TTL)
+            generated = text is None
+            if generated:
+                response = await self.model.generate_content_async(prompt)
+                text = response.text.strip()
+                
+                if text.startswith('```json'):
+                    text = text.replace('```json', '').replace('```', '').strip()
+                elif text.startswith('```'):
+                    text = text.replace('```', '').strip()
             
-            import json
             outline = json.loads(text)
+            if generated:
+                # Stored only once it parses, so a malformed reply is retried next time
+                self.response_cache.put(cache_key, text, "outline")
+            
+            if self.speculative_expansion:
+                self._speculate_expansion(topic, outline, doc_type)
             
             self.status = AgentStatus.SUCCESS
             return AgentResponse(
@@ -242,58 +305,27 @@ Return ONLY valid JSON, no markdown, no explanations."""
         except Exception as e:
             raise Exception(f"Error generating outline: {str(e)}")
     
-    def _expand_outline(self, request: Dict[str, Any]) -> AgentResponse:
+    async def _expand_outline(self, request: Dict[str, Any], writes: List[tuple]) -> AgentResponse:
         self.validate_request(request, ["topic", "outline"])
         
         topic = request["topic"]
         outline = request["outline"]
         doc_type = request.get("document_type", "document")
         tone = request.get("tone", "professional")
-        format_type = request.get("format", "markdown")
+        format_type = request.get("format", "markdown").lower()
         length = request.get("length", "medium")
         
-        if isinstance(outline, dict):
-            sections_list = [s.get("section", "") for s in outline.get("sections", [])]
-        elif isinstance(outline, list):
-            sections_list = outline
-        else:
-            sections_list = [str(outline)]
-        
-        length_guidance = {
-            "short": "500-800 words total",
-            "medium": "1200-2000 words total",
-            "long": "2500-4000 words total"
-        }
-        
-        prompt = f"""Expand this outline into a complete {doc_type} on: {topic}
-
-OUTLINE:
-{self._format_outline_for_prompt(outline)}
-
-DOCUMENT REQUIREMENTS:
-- Type: {doc_type}
-- Tone: {tone}
-- Length: {length_guidance.get(length, length_guidance['medium'])}
-- Format: {format_type}
-
-Write the full document following the outline structure. Include:
-- Detailed content for each section
-- Smooth transitions
-- Relevant examples and analysis
-- Proper formatting for {format_type}
-
-Generate the complete document now:"""
-        
         try:
-            response = self.model.generate_content(prompt)
-            document_content = response.text.strip()
+            # A speculative expansion started when this outline was generated, if it is unchanged
+            document_content = await self._take_speculation(topic, outline, doc_type, tone, format_type, length)
+            if document_content is None:
+                document_content = await self._expand_outline_content(topic, outline, doc_type, tone, format_type, length)
             
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             filename = f"document_{timestamp}.{self._get_file_extension(format_type)}"
             file_path = self.output_dir / filename
             
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(document_content)
+            writes.append((file_path, document_content))
             
             self.status = AgentStatus.SUCCESS
             return AgentResponse(
@@ -313,12 +345,81 @@ Generate the complete document now:"""
         except Exception as e:
             raise Exception(f"Error expanding outline: {str(e)}")
     
-    def _refine_document(self, request: Dict[str, Any]) -> AgentResponse:
+    async def _expand_outline_content(self, topic: str, outline: Any, doc_type: str, tone: str, format_type: str, length: str) -> str:
+        section_prompts = self._build_section_prompts(outline, topic, doc_type, tone, format_type, length)
+        if len(section_prompts) > 1:
+            # One prompt per outline section, sent together and stitched back in order
+            return "\n\n".join(await self._batch_generate(section_prompts))
+        
+        prompt = f"""Expand this outline into a complete {doc_type} on: {topic}
+
+OUTLINE:
+{self._format_outline_for_prompt(outline)}
+
+DOCUMENT REQUIREMENTS:
+- Type: {doc_type}
+- Tone: {tone}
+- Length: {self.LENGTH_GUIDANCE.get(length, self.LENGTH_GUIDANCE['medium'])}
+- Format: {format_type}
+
+Write the full document following the outline structure. Include:
+- Detailed content for each section
+- Smooth transitions
+- Relevant examples and analysis
+- Proper formatting for {format_type}
+
+Generate the complete document now:"""
+        response = await self.model.generate_content_async(prompt)
+        return response.text.strip()
+    
+    def _speculation_key(self, topic: str, outline: Any, doc_type: str, tone: str, format_type: str, length: str) -> str:
+        return ResponseCache.key("expand", topic, doc_type, tone, format_type, length, json.dumps(outline, sort_keys=True))
+    
+    def _speculate_expansion(self, topic: str, outline: Any, doc_type: str) -> None:
+        """
+        Starts expanding a freshly generated outline in the background with the default
+        expand settings, so an unedited "expand" request can pick up the finished text.
+        """
+        now = time.monotonic()
+        self._evict_speculations(now)
+        
+        tone, format_type, length = "professional", "markdown", "medium"
+        key = self._speculation_key(topic, outline, doc_type, tone, format_type, length)
+        if key in self._speculations:
+            return
+        # A task on the shared model loop, next to the request that generated the outline
+        future = submit(self._expand_outline_content(topic, outline, doc_type, tone, format_type, length))
+        self._speculations[key] = (future, now)
+    
+    def _evict_speculations(self, now: float) -> None:
+        """Cancels and drops speculative expansions nobody claimed within SPECULATION_TTL"""
+        for key, (future, started) in list(self._speculations.items()):
+            if now - started > self.SPECULATION_TTL:
+                future.cancel()
+                del self._speculations[key]
+    
+    async def _take_speculation(self, topic: str, outline: Any, doc_type: str, tone: str, format_type: str, length: str) -> Optional[str]:
+        if not self._speculations:
+            return None
+        self._evict_speculations(time.monotonic())
+        entry = self._speculations.pop(self._speculation_key(topic, outline, doc_type, tone, format_type, length), None)
+        if entry is None:
+            return None
+        try:
+            return await asyncio.wrap_future(entry[0])
+        except Exception as e:
+            print(f"[DOCUMENT AGENT] Speculative expansion failed, expanding again: {e}")
+            return None
+    
+    async def _refine_document(self, request: Dict[str, Any], writes: List[tuple]) -> AgentResponse:
         self.validate_request(request, ["document", "changes"])
         
         document = request["document"]
         changes = request["changes"]
-        format_type = request.get("format", "markdown")
+        format_type = request.get("format", "markdown").lower()
+        
+        # Only the sections the change request names are sent and spliced back, when it names any
+        targeted = self._match_sections(document, changes)
         
         prompt = f"""Refine and improve this document based on the requested changes.
 
@@ -336,15 +437,21 @@ Update the document to incorporate these changes while maintaining:
 Return the complete refined document:"""
         
         try:
-            response = self.model.generate_content(prompt)
-            refined_content = response.text.strip()
+            if targeted:
+                section_prompts = [self._build_section_refine_prompt(section, changes, format_type) for section in targeted]
+                refined_content = document
+                for section, refined_section in zip(targeted, await self._batch_generate(section_prompts)):
+                    trailing = section[len(section.rstrip()):]
+                    refined_content = refined_content.replace(section, refined_section + trailing, 1)
+            else:
+                response = await self.model.generate_content_async(prompt)
+                refined_content = response.text.strip()
             
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             filename = f"document_refined_{timestamp}.{self._get_file_extension(format_type)}"
             file_path = self.output_dir / filename
             
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(refined_content)
+            writes.append((file_path, refined_content))
             
             self.status = AgentStatus.SUCCESS
             return AgentResponse(
@@ -356,11 +463,184 @@ Return the complete refined document:"""
                     "file_path": str(file_path),
                     "changes_applied": changes
                 },
-                metadata={"format": format_type}
+                metadata={"format": format_type, "sections_refined": len(targeted) or None}
             )
         except Exception as e:
             raise Exception(f"Error refining document: {str(e)}")
     
+    def _split_sections(self, document: str) -> List[tuple]:
+        """Splits a markdown document at its headings into (heading title, section text) pairs"""
+        matches = list(_HEADING_RE.finditer(document))
+        sections = []
+        for i, match in enumerate(matches):
+            end = matches[i + 1].start() if i + 1 < len(matches) else len(document)
+            sections.append((match.group(1), document[match.start():end]))
+        return sections
+    
+    def _match_sections(self, document: str, changes: str) -> List[str]:
+        """
+        Returns the text of each section whose heading the change request refers to.
+        Empty when no heading matches well enough, or the matches cover most of the document,
+        in which case the whole document is refined.
+        """
+        sections = self._split_sections(document)
+        if len(sections) < 2:
+            return []
+        
+        changes_folded = changes.casefold()
+        matched = []
+        for title, text in sections:
+            title_folded = title.casefold()
+            if fuzz is not None:
+                score = fuzz.partial_ratio(title_folded, changes_folded)
+            else:
+                score = 100 if title_folded in changes_folded else 0
+            if score >= self.SECTION_MATCH_THRESHOLD:
+                matched.append(text)
+        
+        if sum(len(text) for text in matched) > len(document) // 2:
+            return []
+        return matched
+    
+    def _build_section_refine_prompt(self, section: str, changes: str, format_type: str) -> str:
+        return f"""Refine one section of a larger document based on the requested changes.
+
+ORIGINAL SECTION:
+{section.strip()}
+
+REQUESTED CHANGES (apply only what concerns this section):
+{changes}
+
+Update the section to incorporate these changes while maintaining:
+- Original tone and style
+- The section heading and structure
+- {format_type} formatting
+
+Return ONLY the complete refined section, starting with its heading:"""
+    
+    async def _generate_with_prefix(self, doc_type: str, format_type: str, length: str, dynamic_suffix: str, file_path: Path) -> str:
+        """
+        Generates from the static draft instructions plus a per-request suffix, streaming into file_path.
+        The instructions are sent inline: at a few hundred tokens they are far below the minimum
+        size Gemini context caching accepts.
+        """
+        static_prefix = self._build_draft_prefix(doc_type, format_type, length)
+        return await self._stream_to_file(self.model, f"{static_prefix}\n\n{dynamic_suffix}", file_path)
+    
+    async def _stream_to_file(self, model: Any, prompt: str, file_path: Path) -> str:
+        """
+        Streams a generation into file_path chunk by chunk and returns the full text.
+        Chunks go to a temp file beside it that replaces file_path only once the stream
+        completes, so a failed generation never leaves a truncated document behind.
+        """
+        response = await model.generate_content_async(prompt, stream=True)
+        chunks = []
+        f = await asyncio.to_thread(
+            tempfile.NamedTemporaryFile, 'w', encoding='utf-8', buffering=1 << 16,
+            dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".part", delete=False,
+        )
+        try:
+            async for chunk in response:
+                text = chunk.text
+                if not chunks:
+                    text = text.lstrip()
+                chunks.append(text)
+                f.write(text)
+            await asyncio.to_thread(f.close)
+            await asyncio.to_thread(os.replace, f.name, file_path)
+        except BaseException:
+            f.close()
+            Path(f.name).unlink(missing_ok=True)
+            raise
+        return "".join(chunks).strip()
+    
+    def _build_draft_prefix(self, doc_type: str, format_type: str, length: str) -> str:
+        """Static instructions for a (doc_type, format, length); request values are filled from <var> tags"""
+        key = (doc_type, format_type, length)
+        prefix = self._draft_prefixes.get(key)
+        if prefix is None:
+            prefix = self._draft_prefixes[key] = self._render_draft_prefix(doc_type, format_type, length)
+        return prefix
+    
+    def _render_draft_prefix(self, doc_type: str, format_type: str, length: str) -> str:
+        return f"""You are an expert document writer. Create a {doc_type} on the given <topic>.
+
+DOCUMENT REQUIREMENTS:
+- Type: {doc_type}
+- Tone: as given in <tone>
+- Length: {self.LENGTH_GUIDANCE.get(length, self.LENGTH_GUIDANCE['medium'])}
+- Format: {format_type}
+
+SECTIONS TO INCLUDE:
+Use the sections listed in <sections>.
+Take any extra context in <additional_info> into account.
+
+INSTRUCTIONS:
+1. Write a comprehensive, well-structured {doc_type}
+2. Use the <tone> tone throughout
+3. Follow the section structure provided
+4. Include relevant details, examples, and analysis
+5. Make it engaging and informative
+6. Ensure smooth transitions between sections
+
+OUTPUT FORMAT:
+- Use {format_type} formatting
+- Include proper headings and structure
+- Use markdown syntax if format is markdown
+- Use HTML tags if format is HTML
+- Use plain text with clear section breaks if format is text"""
+    
+    async def _batch_generate(self, prompts: List[str]) -> List[str]:
+        """Sends all prompts to Gemini concurrently and returns their texts in the same order"""
+        responses = await asyncio.gather(*[self.model.generate_content_async(p) for p in prompts])
+        return [response.text.strip() for response in responses]
+    
+    def _build_section_prompts(self, outline: Any, topic: str, doc_type: str, tone: str, format_type: str, length: str) -> List[str]:
+        """Builds one prompt per section of a structured outline, or [] if the outline has no sections"""
+        if not isinstance(outline, dict):
+            return []
+        sections = outline.get("sections", [])
+        if not sections:
+            return []
+        
+        total_words = {"short": 650, "medium": 1600, "long": 3250}.get(length, 1600)
+        section_words = max(total_words // len(sections), 100)
+        outline_text = self._format_outline_for_prompt(outline)
+        
+        prompts = []
+        for section in sections:
+            subsections = section.get("subsections") or []
+            prompts.append(f"""Write one section of a {doc_type} on: {topic}
+
+FULL OUTLINE (for context only):
+{outline_text}
+
+SECTION TO WRITE:
+Section: {section.get('section', '')}
+Description: {section.get('description', '')}
+{"Subsections: " + ", ".join(subsections) if subsections else ""}
+
+REQUIREMENTS:
+- Tone: {tone}
+- Length: about {section_words} words
+- Format: {format_type}
+- Start with the section heading
+- Write only this section; do not repeat other sections or add a document title
+
+Generate the section now:""")
+        return prompts
+    
+    async def _flush_writes(self, pending: List[tuple]) -> None:
+        """Writes the given (path, content) pairs off the event loop in a single worker-thread hop"""
+        if not pending:
+            return
+        await asyncio.to_thread(self._write_documents, pending)
+    
+    def _write_documents(self, pending: List[tuple]) -> None:
+        for file_path, content in pending:
+            with open(file_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+                f.write(content)
+    
     def _format_sections(self, sections: List[str]) -> str:
         if isinstance(sections, list):
             return "\n".join([f"- {section}" for section in sections])
@@ -382,12 +662,8 @@ Return the complete refined document:"""
             return str(outline)
     
     def _get_file_extension(self, format_type: str) -> str:
-        extensions = {
-            "markdown": "md",
-            "html": "html",
-            "text": "txt"
-        }
-        return extensions.get(format_type.lower(), "txt")
+        # format_type is lower-cased once by each action
+        return _EXT_MAP.get(format_type, "txt")
     
     def get_capabilities(self) -> Dict[str, Any]:
         base_caps = super().get_capabilities()
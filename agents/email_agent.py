@@ -2,22 +2,117 @@ from __future__ import annotations
 
 import os
 import re
-from typing import Any, Dict, Optional
+import asyncio
+import functools
+import importlib.util
+from itertools import groupby
+from typing import Any, Dict, List, Optional
 
 from agents.base_agent import BaseAgent, AgentResponse, AgentStatus
+from agents.gemini_models import get_model, run_sync
+from agents.response_cache import ResponseCache
 
 try:
     import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 except ImportError:
     raise ImportError("Install requests: pip install requests")
 
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+try:
+    from markdown_it import MarkdownIt
+    # breaks: keep the model's line-per-paragraph replies ("Hi X,\nThanks...") on separate lines
+    _MD = MarkdownIt("commonmark", {"breaks": True}).enable(["table", "strikethrough"])
+    try:
+        import linkify_it  # noqa: F401  (markdown-it's linkify rule needs linkify-it-py)
+        _MD.options["linkify"] = True
+        _MD.enable("linkify")
+    except ImportError:
+        pass
+except ImportError:
+    _MD = None
+
 try:
     import google.generativeai as genai
 except ImportError:
     raise ImportError("Install google-genai: pip install google-genai")
 
+_EMAIL_RE = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
+_NAME_RE = re.compile(r'(?:to|for|send to|email to|write to)\s+([A-Z][a-z]+)', re.IGNORECASE)
+_RECIPIENT_EMAIL_ID, _RECIPIENT_NAME_ID = 0, 1
+
+
+@functools.lru_cache(maxsize=None)
+def _recipient_scanner() -> Any:
+    """
+    Hyperscan database matching the email and name patterns in one pass, or None when
+    Hyperscan isn't installed. Its ASCII word boundaries make it a superset of the re
+    patterns, so it is used as a prefilter and re extracts the exact matches.
+    """
+    if hyperscan is None:
+        return None
+    db = hyperscan.Database()
+    db.compile(
+        expressions=[_EMAIL_RE.pattern.encode(), _NAME_RE.pattern.encode()],
+        ids=[_RECIPIENT_EMAIL_ID, _RECIPIENT_NAME_ID],
+        elements=2,
+        flags=[hyperscan.HS_FLAG_SINGLEMATCH, hyperscan.HS_FLAG_SINGLEMATCH | hyperscan.HS_FLAG_CASELESS],
+    )
+    return db
+
+
+_BODY_RE = re.compile(r'<body[^>]*>(.*?)</body>', re.DOTALL | re.IGNORECASE)
+# DOCTYPE, <html>/</html>, <head>...</head> and <style>...</style>, stripped in one pass
+_CLEANUP_RE = re.compile(
+    r'<!DOCTYPE[^>]*>|</?html[^>]*>|<head[^>]*>.*?</head>|<style[^>]*>.*?</style>',
+    re.DOTALL | re.IGNORECASE
+)
+
+# Invariant document wrapper for _convert_to_html; the body is joined in between
+_HTML_SHELL_START = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <style>
+        body { 
+            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; 
+            color: #333; 
+            line-height: 1.6; 
+            padding: 20px;
+            max-width: 600px;
+        }
+        p { margin: 0.5em 0; }
+        ul { margin: 0.5em 0; padding-left: 20px; }
+        li { margin: 0.3em 0; }
+        a { color: #0066cc; text-decoration: none; }
+        a:hover { text-decoration: underline; }
+    </style>
+</head>
+<body>
+    """
+_HTML_SHELL_END = """
+</body>
+</html>"""
+# One match per line, whitespace-trimmed: group 1 is a "- "/"* " bullet's text, group 2 any other line
+_LINE_RE = re.compile(r'^[^\S\n]*(?:[-*] (.*?\S)|(.*?))[^\S\n]*$', re.MULTILINE)
+_P_OPEN = "<p style='margin: 0.5em 0;'>"
+_UL_OPEN = "<ul style='margin: 0.5em 0;'>"
+
 
 class EmailAgent(BaseAgent):
+    BULK_SEND_CONCURRENCY = 20
+    RESPONSE_CACHE_TTL = ResponseCache.DEFAULT_MAX_AGE  # seconds a cached draft or subject is reused
+    
     def __init__(self, config: Optional[Dict[str, Any]] = None):
         super().__init__(
             name="Email Agent",
@@ -31,11 +126,27 @@ class EmailAgent(BaseAgent):
         self.gemini_api_key = self.config.get("gemini_api_key") or os.getenv("GEMINI_API_KEY")
         self.model_name = self.config.get("model_name", "gemini-2.0-flash")
         
-        if self.gemini_api_key:
-            genai.configure(api_key=self.gemini_api_key)
-            self.ai_model = genai.GenerativeModel(self.model_name)
-        else:
-            self.ai_model = None
+        # Keep-alive session so repeated sends reuse the Mailgun TLS connection.
+        # Only connection failures and 429/503 are retried: Mailgun never accepted the message,
+        # so a resend can't duplicate it. Read errors (request already delivered) are not retried.
+        self._http = requests.Session()
+        self._http.auth = ("api", self.mailgun_api_key)
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(total=3, read=0, backoff_factor=0.3, status_forcelist=[429, 503], allowed_methods=["POST"])
+        )
+        self._http.mount("https://", adapter)
+        
+        # Drafted bodies keyed by normalized prompt + tone, so retries skip Gemini
+        self.response_cache = ResponseCache(self.config.get("response_cache_path", "outputs/.response_cache.sqlite3"))
+    
+    @functools.cached_property
+    def ai_model(self) -> Optional["genai.GenerativeModel"]:
+        # Built on first use, so send-only agents never create a Gemini model
+        if not self.gemini_api_key:
+            return None
+        return get_model(self.gemini_api_key, self.model_name)
     
     def process(self, request: Dict[str, Any]) -> AgentResponse:
         self.status = AgentStatus.PROCESSING
@@ -49,6 +160,10 @@ class EmailAgent(BaseAgent):
                 return self._draft_email(request)
             elif action == "reply":
                 return self._draft_reply(request)
+            elif action == "reply_bulk":
+                return self._draft_replies_bulk(request)
+            elif action == "send_bulk":
+                return self._send_bulk(request)
             else:
                 raise ValueError(f"Unknown action: {action}")
                 
@@ -67,24 +182,11 @@ class EmailAgent(BaseAgent):
         
         to_email = request["to"]
         subject = request["subject"]
-        body = request["body"]
-        is_html = request.get("html", True)
         
-        if is_html and not body.strip().startswith("<"):
-            body = self._convert_to_html(body)
-        
-        response = requests.post(
-            f"https://api.mailgun.net/v3/{self.mailgun_domain}/messages",
-            auth=("api", self.mailgun_api_key),
-            data={
-                "from": self.from_email,
-                "to": to_email,
-                "subject": subject,
-                "html" if is_html else "text": body
-            }
-        )
+        response = self._http.post(self._mailgun_url(), data=self._build_message(request))
         
         if response.status_code == 200:
+            mailgun_response = response.json()
             self.status = AgentStatus.SUCCESS
             return AgentResponse(
                 agent_name=self.name,
@@ -93,13 +195,86 @@ class EmailAgent(BaseAgent):
                     "sent": True,
                     "to": to_email,
                     "subject": subject,
-                    "message_id": response.json().get("id")
+                    "message_id": mailgun_response.get("id")
                 },
-                metadata={"mailgun_response": response.json()}
+                metadata={"mailgun_response": mailgun_response}
             )
         else:
             raise Exception(f"Mailgun error: {response.text}")
     
+    def _send_bulk(self, request: Dict[str, Any]) -> AgentResponse:
+        self.validate_request(request, ["emails"])
+        
+        emails = request["emails"]
+        for email in emails:
+            self.validate_request(email, ["to", "subject", "body"])
+        
+        # On the shared loop like the Gemini calls, so this also works when a loop is already running
+        outcomes = run_sync(self._send_emails_bulk(emails))
+        
+        results = []
+        for email, outcome in zip(emails, outcomes):
+            if isinstance(outcome, Exception):
+                results.append({"sent": False, "to": email["to"], "subject": email["subject"], "error": str(outcome)})
+            elif outcome.status_code == 200:
+                results.append({"sent": True, "to": email["to"], "subject": email["subject"], "message_id": outcome.json().get("id")})
+            else:
+                results.append({"sent": False, "to": email["to"], "subject": email["subject"], "error": f"Mailgun error: {outcome.text}"})
+        
+        sent = sum(1 for r in results if r["sent"])
+        self.status = AgentStatus.SUCCESS
+        return AgentResponse(
+            agent_name=self.name,
+            status=AgentStatus.SUCCESS,
+            result={"results": results, "sent": sent, "failed": len(results) - sent},
+            metadata={"count": len(results)}
+        )
+    
+    async def _send_emails_bulk(self, emails: List[Dict[str, Any]]) -> List[Any]:
+        """
+        Posts every email to Mailgun concurrently, at most BULK_SEND_CONCURRENCY at a time.
+        Returns one response or exception per email, so a single failure doesn't abort the batch.
+        """
+        url = self._mailgun_url()
+        messages = [self._build_message(email) for email in emails]
+        sem = asyncio.Semaphore(self.BULK_SEND_CONCURRENCY)
+        
+        if httpx is None:
+            # No async HTTP client installed: run the pooled session's posts on worker threads
+            async def _one(data):
+                async with sem:
+                    return await asyncio.to_thread(self._http.post, url, data=data)
+            return await asyncio.gather(*[_one(data) for data in messages], return_exceptions=True)
+        
+        limits = httpx.Limits(
+            max_connections=self.BULK_SEND_CONCURRENCY,
+            max_keepalive_connections=self.BULK_SEND_CONCURRENCY
+        )
+        http2 = importlib.util.find_spec("h2") is not None
+        async with httpx.AsyncClient(auth=("api", self.mailgun_api_key), limits=limits, http2=http2) as client:
+            async def _one(data):
+                async with sem:
+                    return await client.post(url, data=data)
+            return await asyncio.gather(*[_one(data) for data in messages], return_exceptions=True)
+    
+    def _mailgun_url(self) -> str:
+        return f"https://api.mailgun.net/v3/{self.mailgun_domain}/messages"
+    
+    def _build_message(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Mailgun form fields for one send request"""
+        body = request["body"]
+        is_html = request.get("html", True)
+        
+        if is_html and not body.strip().startswith("<"):
+            body = self._convert_to_html(body)
+        
+        return {
+            "from": self.from_email,
+            "to": request["to"],
+            "subject": request["subject"],
+            "html" if is_html else "text": body
+        }
+    
     def _draft_email(self, request: Dict[str, Any]) -> AgentResponse:
         self.validate_request(request, ["prompt"])
         
@@ -109,16 +284,10 @@ class EmailAgent(BaseAgent):
         prompt = request["prompt"]
         tone = request.get("tone", "professional but friendly")
         
-        # Extract recipient email from prompt
-        import re
-        email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-        email_matches = re.findall(email_pattern, prompt)
-        to_email = email_matches[0] if email_matches else ""
-        
-        # Extract recipient name if mentioned
-        name_pattern = r'(?:to|for|send to|email to|write to)\s+([A-Z][a-z]+)'
-        name_match = re.search(name_pattern, prompt, re.IGNORECASE)
-        recipient_name = name_match.group(1) if name_match else ""
+        # Extract recipient email and name (if mentioned) from prompt
+        recipient = self._extract_recipient(prompt)
+        to_email = recipient["emails"][0] if recipient["emails"] else ""
+        recipient_name = recipient["recipient_name"]
         
         system_prompt = f"""You are an expert email writer. Create a professional, well-formatted email.
 
@@ -140,24 +309,24 @@ Return ONLY the HTML body (no subject line). Include:
 - Professional closing (Best regards, Thanks, etc.)
 - No extra explanations outside the email"""
 
-        response = self.ai_model.generate_content(system_prompt)
-        html_body = response.text.strip()
+        cache_key = ResponseCache.key("email_draft", prompt, tone)
+        html_body = self.response_cache.get(cache_key, max_age=self.RESPONSE_CACHE_TTL)
+        if html_body is None:
+            response = self.ai_model.generate_content(system_prompt)
+            html_body = response.text.strip()
+            self.response_cache.put(cache_key, html_body, "email_draft")
         
         # Remove markdown code block markers (handle multiple variations)
         html_body = html_body.replace("```html", "").replace("```", "").strip()
         
         # Extract body content if full HTML document
         if "<body" in html_body:
-            body_match = re.search(r'<body[^>]*>(.*?)</body>', html_body, re.DOTALL | re.IGNORECASE)
+            body_match = _BODY_RE.search(html_body)
             if body_match:
                 html_body = body_match.group(1).strip()
         
         # Remove DOCTYPE, html, head tags if present
-        html_body = re.sub(r'<!DOCTYPE[^>]*>', '', html_body, flags=re.IGNORECASE)
-        html_body = re.sub(r'<html[^>]*>', '', html_body, flags=re.IGNORECASE)
-        html_body = re.sub(r'</html>', '', html_body, flags=re.IGNORECASE)
-        html_body = re.sub(r'<head[^>]*>.*?</head>', '', html_body, flags=re.DOTALL | re.IGNORECASE)
-        html_body = re.sub(r'<style[^>]*>.*?</style>', '', html_body, flags=re.DOTALL | re.IGNORECASE)
+        html_body = _CLEANUP_RE.sub('', html_body)
         
         # Remove any leading/trailing whitespace and newlines
         html_body = html_body.strip()
@@ -196,7 +365,70 @@ Return ONLY the HTML body (no subject line). Include:
         reply_prompt = request["reply_prompt"]
         tone = request.get("tone", "professional but friendly")
         
-        system_prompt = f"""You are an expert email writer. Create a professional reply email.
+        response = self.ai_model.generate_content(self._build_reply_prompt(original, reply_prompt, tone))
+        html_body = self._clean_reply_body(response.text)
+        
+        self.status = AgentStatus.SUCCESS
+        return AgentResponse(
+            agent_name=self.name,
+            status=AgentStatus.SUCCESS,
+            result={
+                "subject": f"Re: {original.get('subject', 'Your email')}",
+                "body": html_body,
+                "draft": True
+            },
+            metadata={"reply_to": original.get("from"), "tone": tone}
+        )
+    
+    def _draft_replies_bulk(self, request: Dict[str, Any]) -> AgentResponse:
+        """
+        Drafts replies to several emails at once. reply_prompt is either one instruction
+        shared by every email or a list with one instruction per email.
+        """
+        self.validate_request(request, ["original_emails", "reply_prompt"])
+        
+        if not self.ai_model:
+            raise ValueError("Gemini API key required for drafting replies")
+        
+        originals = request["original_emails"]
+        reply_prompts = request["reply_prompt"]
+        tone = request.get("tone", "professional but friendly")
+        
+        if isinstance(reply_prompts, str):
+            reply_prompts = [reply_prompts] * len(originals)
+        if len(reply_prompts) != len(originals):
+            raise ValueError("reply_prompt must be a string or a list matching original_emails")
+        
+        prompts = [
+            self._build_reply_prompt(original, reply_prompt, tone)
+            for original, reply_prompt in zip(originals, reply_prompts)
+        ]
+        
+        async def _gather():
+            return await asyncio.gather(*[self.ai_model.generate_content_async(p) for p in prompts])
+        # On the shared model loop: the async client is bound to the loop it first ran on
+        responses = run_sync(_gather())
+        
+        replies = [
+            {
+                "subject": f"Re: {original.get('subject', 'Your email')}",
+                "body": self._clean_reply_body(response.text),
+                "reply_to": original.get("from"),
+                "draft": True
+            }
+            for original, response in zip(originals, responses)
+        ]
+        
+        self.status = AgentStatus.SUCCESS
+        return AgentResponse(
+            agent_name=self.name,
+            status=AgentStatus.SUCCESS,
+            result={"replies": replies, "count": len(replies)},
+            metadata={"tone": tone}
+        )
+    
+    def _build_reply_prompt(self, original: Dict[str, Any], reply_prompt: str, tone: str) -> str:
+        return f"""You are an expert email writer. Create a professional reply email.
 
 ORIGINAL EMAIL:
 {original}
@@ -217,9 +449,9 @@ Return ONLY the HTML reply body. Structure:
 - Context acknowledgment
 - Your response
 - Closing"""
-
-        response = self.ai_model.generate_content(system_prompt)
-        html_body = response.text.strip()
+    
+    def _clean_reply_body(self, text: str) -> str:
+        html_body = text.strip()
         
         if html_body.startswith("```html"):
             html_body = html_body.replace("```html", "").replace("```", "").strip()
@@ -228,18 +460,33 @@ Return ONLY the HTML reply body. Structure:
         
         if not html_body.startswith("<"):
             html_body = self._convert_to_html(html_body)
+        return html_body
+    
+    def extract_recipients_batch(self, texts: List[str]) -> List[Dict[str, Any]]:
+        """
+        Finds the email addresses and first recipient name in each of many messages.
+        With Hyperscan installed every message is scanned once for both patterns, and
+        re only runs on the messages that matched.
+        """
+        db = _recipient_scanner()
+        if db is None:
+            return [self._extract_recipient(text) for text in texts]
         
-        self.status = AgentStatus.SUCCESS
-        return AgentResponse(
-            agent_name=self.name,
-            status=AgentStatus.SUCCESS,
-            result={
-                "subject": f"Re: {original.get('subject', 'Your email')}",
-                "body": html_body,
-                "draft": True
-            },
-            metadata={"reply_to": original.get("from"), "tone": tone}
-        )
+        results = []
+        for text in texts:
+            hits = set()
+            db.scan(text.encode("utf-8"), match_event_handler=lambda pattern_id, start, end, flags, ctx: hits.add(pattern_id))
+            results.append(self._extract_recipient(
+                text,
+                has_email=_RECIPIENT_EMAIL_ID in hits,
+                has_name=_RECIPIENT_NAME_ID in hits
+            ))
+        return results
+    
+    def _extract_recipient(self, text: str, has_email: bool = True, has_name: bool = True) -> Dict[str, Any]:
+        emails = _EMAIL_RE.findall(text) if has_email else []
+        name_match = _NAME_RE.search(text) if has_name else None
+        return {"emails": emails, "recipient_name": name_match.group(1) if name_match else ""}
     
     def _generate_subject(self, prompt: str) -> str:
         if not self.ai_model:
@@ -256,67 +503,39 @@ RULES:
 - Professional tone
 
 Return ONLY the subject line text."""
-        response = self.ai_model.generate_content(subject_prompt)
-        return response.text.strip().strip('"').strip("'")
+        # Templated prompts (standups, reminders, thank-yous) keep getting the same subject
+        cache_key = ResponseCache.key("email_subject", prompt)
+        subject = self.response_cache.get(cache_key, max_age=self.RESPONSE_CACHE_TTL)
+        if subject is None:
+            response = self.ai_model.generate_content(subject_prompt)
+            subject = response.text.strip().strip('"').strip("'")
+            self.response_cache.put(cache_key, subject, "email_subject")
+        return subject
     
     def _convert_to_html(self, text: str) -> str:
-        lines = text.strip().split("\n")
-        html_lines = []
+        if _MD is not None:
+            # Full CommonMark (headings, links, code, tables) when markdown-it-py is installed
+            return "".join((_HTML_SHELL_START, _MD.render(text.strip()), _HTML_SHELL_END))
         
-        in_list = False
-        for line in lines:
-            line = line.strip()
-            if not line:
-                if in_list:
-                    html_lines.append("</ul>")
-                    in_list = False
-                continue
-            
-            if line.startswith("- ") or line.startswith("* "):
-                if not in_list:
-                    html_lines.append("<ul style='margin: 0.5em 0;'>")
-                    in_list = True
-                html_lines.append(f"<li>{line[2:]}</li>")
-            else:
-                if in_list:
-                    html_lines.append("</ul>")
-                    in_list = False
-                html_lines.append(f"<p style='margin: 0.5em 0;'>{line}</p>")
+        # Each line is a (bullet text, paragraph text) pair; blank lines are ("", "")
+        lines = _LINE_RE.findall(text.strip())
+        html_lines = []
         
-        if in_list:
-            html_lines.append("</ul>")
+        for kind, group in groupby(lines, key=lambda m: "li" if m[0] else ("p" if m[1] else "")):
+            if kind == "li":
+                # Consecutive bullets become one list; a blank line or paragraph ends it
+                html_lines.append("".join((_UL_OPEN, "".join(["".join(("<li>", m[0], "</li>")) for m in group]), "</ul>")))
+            elif kind == "p":
+                html_lines.append("".join(["".join((_P_OPEN, m[1], "</p>")) for m in group]))
         
-        html = f"""<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <style>
-        body {{ 
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; 
-            color: #333; 
-            line-height: 1.6; 
-            padding: 20px;
-            max-width: 600px;
-        }}
-        p {{ margin: 0.5em 0; }}
-        ul {{ margin: 0.5em 0; padding-left: 20px; }}
-        li {{ margin: 0.3em 0; }}
-        a {{ color: #0066cc; text-decoration: none; }}
-        a:hover {{ text-decoration: underline; }}
-    </style>
-</head>
-<body>
-    {"".join(html_lines)}
-</body>
-</html>"""
-        return html
+        return "".join((_HTML_SHELL_START, "".join(html_lines), _HTML_SHELL_END))
     
     def get_capabilities(self) -> Dict[str, Any]:
         base_caps = super().get_capabilities()
         base_caps.update({
-            "actions": ["send", "draft", "reply"],
+            "actions": ["send", "send_bulk", "draft", "reply", "reply_bulk"],
             "has_mailgun": bool(self.mailgun_api_key and self.mailgun_domain),
-            "has_ai": bool(self.ai_model),
+            "has_ai": bool(self.gemini_api_key),
             "from_email": self.from_email
         })
         return base_caps
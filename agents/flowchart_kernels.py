@@ -0,0 +1,57 @@
+"""
+Optional Numba kernels for flowchart_sanitize.
+
+Kept apart from that module because Numba can only JIT plain Python functions, not
+the native code mypyc produces. Importing this module pulls in numpy and numba, so
+flowchart_sanitize only does so for large documents.
+"""
+from __future__ import annotations
+
+from typing import List, Optional
+
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    np = None
+    njit = None
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _balances(buf):
+        """Per line of UTF-8 bytes: opening minus closing count of [ ], { } and ( )"""
+        n_lines = 1
+        for i in range(buf.shape[0]):
+            if buf[i] == 10:
+                n_lines += 1
+        out = np.zeros((n_lines, 3), np.int64)
+        row = 0
+        for i in range(buf.shape[0]):
+            c = buf[i]
+            if c == 10:  # \n
+                row += 1
+            elif c == 91:  # [
+                out[row, 0] += 1
+            elif c == 93:  # ]
+                out[row, 0] -= 1
+            elif c == 123:  # {
+                out[row, 1] += 1
+            elif c == 125:  # }
+                out[row, 1] -= 1
+            elif c == 40:  # (
+                out[row, 2] += 1
+            elif c == 41:  # )
+                out[row, 2] -= 1
+        return out
+
+
+def line_balances(code: str) -> Optional[List[List[int]]]:
+    """
+    Bracket, brace and parenthesis balance for each line of ``code`` (as split on '\\n'),
+    counted in one compiled pass over the whole document. None if numba is not installed.
+    """
+    if njit is None:
+        return None
+    # UTF-8 never puts a newline or bracket byte inside a multi-byte character
+    return _balances(np.frombuffer(code.encode("utf-8", "replace"), dtype=np.uint8)).tolist()
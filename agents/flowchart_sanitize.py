@@ -0,0 +1,599 @@
+"""
+Pure Mermaid flowchart sanitation used by FlowchartAgent.
+
+Kept free of agent state and fully annotated so it can be compiled with mypyc
+(``mypyc agents/flowchart_sanitize.py``) for a native speedup. The plain Python module
+behaves identically when no compiled build is present.
+"""
+from __future__ import annotations
+
+import re
+import logging
+import functools
+from typing import List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+_LABEL_TRANSLATE = str.maketrans({'"': "'", '`': "'"})
+
+# Patterns used by the per-line sanitizer
+_DOUBLE_DASH_RE = re.compile(r'\s*-\s*-')
+_TRAILING_DASH_RE = re.compile(r'\s*-\s*$')
+_LEADING_DASH_RE = re.compile(r'^\s*-\s*')
+_WHITESPACE_RE = re.compile(r'\s+')
+_NODE_ID_RE = re.compile(r'^([a-zA-Z0-9_]+)')
+_LABEL_CHARS_RE = re.compile(r"[^\w\s\-'()]")
+_DECISION_LABEL_CHARS_RE = re.compile(r"[^\w\s\-'()?]")
+_ARROW_RE = re.compile(r'--\s*>|-\s*->|->')
+_LABELED_EDGE_RE = re.compile(r'^(.+?)\s*-->\s*\|\s*(.+?)\s*\|\s*(.+)$')
+# Patterns that recognise flowcharts needing no repair
+_EXACT_HEADER_RE = re.compile(r'flowchart (?:TD|LR|TB|BT|RL)')
+_QUOTED_LABEL_CHARS_RE = re.compile(r'[():;,\'"`]')
+_NESTED_BRACKET_RE = re.compile(r'[\[{][^\]}]*[\[{]')
+_CANONICAL_LABELED_EDGE_RE = re.compile(r'[^|\s][^|]*\S -->\|[^|\s](?:[^|]*[^|\s])?\| \S[^|]*')
+# Patterns used by the whole-document repair
+_HEADER_RE = re.compile(r'^(flowchart\s+(?:TD|LR|TB|BT|RL))', re.IGNORECASE)
+_END_NODE_DEF_RE = re.compile(r'^([a-zA-Z0-9_]+)([\[{(])((?i:end)\b.*)([\]})])$')
+_AFTER_BRACKET_RE = re.compile(r'\]\s*[^\s\-\|]')
+_AFTER_BRACE_RE = re.compile(r'\}\s*[^\s\-\|]')
+_STRAY_AFTER_CLOSE_RE = re.compile(r'([\]\}\)])\s*[^\s\-\|]')
+_TEXT_AFTER_CLOSE_RE = re.compile(r'(\]|\}|\))\s+[^\s\-\|]')
+_GLUED_AFTER_CLOSE_RE = re.compile(r'(\]|\}|\))([^\s\-\|])')
+_TRAILING_TEXT_RE = re.compile(r'(\]|\}|\))\s+.*$')
+_GLUED_TRAILING_TEXT_RE = re.compile(r'(\]|\}|\))([^\s\-\|].*)$')
+_BRACKET_DOUBLE_DASH_RE = re.compile(r'\[([^\]]*?)\s*-\s*-\s*([^\]]*?)\]')
+_BRACE_DOUBLE_DASH_RE = re.compile(r'\{([^\}]*?)\s*-\s*-\s*([^\}]*?)\}')
+_CLOSE_DOUBLE_DASH_RE = re.compile(r'([^\s])\s*-\s*-\s*([\]\}])')
+_CLOSE_DASH_RE = re.compile(r'([^\s])\s*-\s*([\]\}])')
+_EMPTY_LABEL_RE = re.compile(r'\[[\s-]+\]|\{[\s-]+\}')
+
+# Below this size per-line str.count beats importing numba and calling its kernel
+_KERNEL_MIN_CHARS = 8192
+
+# Patterns used to quote labels with special characters
+_WRAP_BRACKET_RE = re.compile(r'(\s*)([a-zA-Z0-9_]+)\[([^\]]+)\]')
+_WRAP_BRACE_RE = re.compile(r'(\s*)([a-zA-Z0-9_]+)\{([^\}]+)\}')
+_WRAP_PAREN_RE = re.compile(r'(\s*)([a-zA-Z0-9_]+)\(([^\)]+)\)')
+_WRAP_EDGE_LABEL_RE = re.compile(r'(\s*)(.+?)\s*-->\s*\|\s*([^|]+?)\s*\|\s*(.+)')
+_SPECIAL_LABEL_CHARS_RE = re.compile(r'[()\[\]{}:;,\'"`]')
+
+
+# Pure and called with the same ids and labels many times per diagram
+@functools.lru_cache(maxsize=1024)
+def _clean_label(text: str) -> str:
+    """Clean node labels to remove problematic characters"""
+    if not text:
+        return text
+    # Replace double quotes and backticks with single quotes
+    text = text.translate(_LABEL_TRANSLATE)
+    # Remove double dashes and spaces around dashes
+    text = _DOUBLE_DASH_RE.sub('-', text)  # Fix " - -" or "--"
+    text = _TRAILING_DASH_RE.sub('', text)  # Remove trailing dashes with spaces
+    text = _LEADING_DASH_RE.sub('', text)  # Remove leading dashes with spaces
+    # Remove trailing periods, commas, etc. that might break syntax
+    text = text.rstrip('.,;:')
+    # Remove multiple spaces
+    text = _WHITESPACE_RE.sub(' ', text)
+    # Remove any remaining problematic trailing characters
+    text = text.strip()
+    # Ensure label is not empty
+    if not text:
+        text = "Label"
+    return text
+
+
+# (opening, closing, disallowed label characters) in the order node shapes are checked
+_NODE_SHAPES = (
+    ('[', ']', _LABEL_CHARS_RE),
+    ('{', '}', _DECISION_LABEL_CHARS_RE),
+    ('(', ')', _LABEL_CHARS_RE),
+)
+
+
+def _matching_close(text: str, start: int, open_char: str, close_char: str) -> int:
+    """Index of the bracket closing the one at ``start``, accounting for nesting; -1 if unmatched"""
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] == open_char:
+            depth += 1
+        elif text[i] == close_char:
+            depth -= 1
+            if depth == 0:
+                return i
+    return -1
+
+
+@functools.lru_cache(maxsize=1024)
+def _sanitize_node(node_str: str) -> str:
+    """Sanitize a single node definition, dropping anything after its closing bracket"""
+    node_str = node_str.strip()
+    if not node_str:
+        return ""
+    
+    match = _NODE_ID_RE.match(node_str)
+    node_id = match.group(1) if match else "node0"
+    
+    for open_char, close_char, label_chars_re in _NODE_SHAPES:
+        if open_char not in node_str:
+            continue
+        start = node_str.find(open_char)
+        end = node_str.find(close_char, start + 1)
+        if end != -1 and node_str.find(open_char, start + 1, end) != -1:
+            end = _matching_close(node_str, start, open_char, close_char)
+        
+        if end > start:
+            label = node_str[start + 1:end]
+        else:
+            # Unmatched bracket: the label runs up to an arrow or the end of the string
+            label = node_str[start + 1:].partition('-->')[0].strip()
+            cut = label.find(close_char)
+            if cut != -1:
+                label = label[:cut]
+        label = label_chars_re.sub('', _clean_label(label))
+        return f"{node_id}{open_char}{label}{close_char}"
+    
+    # Just a node ID - drop any extra text after it
+    return node_id
+
+
+def _fix_arrow(match: re.Match[str]) -> str:
+    # Only a bare "->" gains a dash. Longer forms keep a stray dash on the source side,
+    # as the former "--\s*>", "-\s*->", "->" substitution chain produced; the node
+    # sanitizer drops it, or turns a missing source into node0.
+    return '-->' if match.group(0) == '->' else '--->'
+
+
+def _sanitize_line(line: str) -> str:
+    """Sanitize one line of Mermaid; returns an empty string for lines to drop"""
+    line = line.strip()
+    if not line or line.startswith('%%'):
+        return ""
+    if line.startswith('flowchart'):
+        return line
+    
+    # Fix arrow syntax ("-- >", "- ->", "->") in one scan
+    if '>' in line:
+        line = _ARROW_RE.sub(_fix_arrow, line)
+    
+    if '-->' in line:
+        # Labeled connection: nodeA -->|label| nodeB
+        labeled_match = _LABELED_EDGE_RE.match(line) if '|' in line else None
+        if labeled_match:
+            left = _sanitize_node(labeled_match.group(1))
+            label = _clean_label(labeled_match.group(2))
+            right = _sanitize_node(labeled_match.group(3))
+            return f"    {left} -->|{label}| {right}"
+        # Simple connection: nodeA --> nodeB; anything after a second arrow is dropped
+        left, _, right = line.partition('-->')
+        right = right.partition('-->')[0]
+        return f"    {_sanitize_node(left)} --> {_sanitize_node(right)}"
+    
+    node = _sanitize_node(line)
+    return f"    {node}" if node else ""
+
+
+def _line_errors(line: str, line_no: int, balance: Optional[List[int]] = None) -> List[str]:
+    """Syntax errors on one stripped line of Mermaid; ``balance`` is its precomputed _line_balances row"""
+    if not line or line.startswith('flowchart') or line.startswith('%%'):
+        return []
+    errors: List[str] = []
+    
+    # Check for unmatched brackets (str.count runs in C, faster than one Python-level pass)
+    if balance is None:
+        square = line.count('[') - line.count(']')
+        curly = line.count('{') - line.count('}')
+        paren = line.count('(') - line.count(')')
+    else:
+        square, curly, paren = balance
+    if square:
+        errors.append(f"Line {line_no}: Unmatched square brackets")
+    if curly:
+        errors.append(f"Line {line_no}: Unmatched curly braces")
+    if paren:
+        errors.append(f"Line {line_no}: Unmatched parentheses")
+    
+    # Check for invalid characters after node definitions; the substring tests are far
+    # cheaper than a regex search on lines without the closing character
+    if '-->' in line:
+        if ']' in line and _AFTER_BRACKET_RE.search(line):
+            errors.append(f"Line {line_no}: Invalid character after closing bracket")
+        if '}' in line and _AFTER_BRACE_RE.search(line):
+            errors.append(f"Line {line_no}: Invalid character after closing brace")
+    return errors
+
+
+def _fix_syntax_line(line: str) -> str:
+    """Close unmatched brackets/braces and drop stray characters after node definitions"""
+    line = line.strip()
+    if not line or line.startswith('flowchart'):
+        return line
+    
+    # Fix unmatched brackets by closing them before the arrow or at the end of the line
+    if '[' in line and ']' not in line:
+        idx = line.find('[')
+        rest = line[idx+1:]
+        if '-->' in rest:
+            arrow_idx = rest.find('-->')
+            label = _LABEL_CHARS_RE.sub('', rest[:arrow_idx].strip())
+            line = line[:idx+1] + label + ']' + rest[arrow_idx:]
+        else:
+            line = line[:idx+1] + _LABEL_CHARS_RE.sub('', rest) + ']'
+    
+    # Fix unmatched braces
+    if '{' in line and '}' not in line:
+        idx = line.find('{')
+        rest = line[idx+1:]
+        if '-->' in rest:
+            arrow_idx = rest.find('-->')
+            label = _DECISION_LABEL_CHARS_RE.sub('', rest[:arrow_idx].strip())
+            line = line[:idx+1] + label + '}' + rest[arrow_idx:]
+        else:
+            line = line[:idx+1] + _DECISION_LABEL_CHARS_RE.sub('', rest) + '}'
+    
+    # Remove trailing problematic characters
+    return _STRAY_AFTER_CLOSE_RE.sub(r'\1', line)
+
+
+def _cleanup_line(line: str) -> str:
+    """Remove text trailing a node definition and fix dashes/empty labels"""
+    line = line.strip()
+    if not line or line.startswith('flowchart'):
+        return line
+    
+    if '-->' in line:
+        # nodeID[Label]    extra_text --> nextNode  becomes  nodeID[Label] --> nextNode
+        left, _, right = line.partition('-->')
+        left = _TEXT_AFTER_CLOSE_RE.sub(r'\1', left.strip())
+        left = _GLUED_AFTER_CLOSE_RE.sub(r'\1', left)
+        return f"    {left} --> {right.strip()}"
+    
+    # Standalone node - remove text after closing brackets
+    line = _TRAILING_TEXT_RE.sub(r'\1', line)
+    line = _GLUED_TRAILING_TEXT_RE.sub(r'\1', line)
+    if '-' in line:
+        # Fix double dashes in labels: " - -" or "--"
+        line = _BRACKET_DOUBLE_DASH_RE.sub(r'[\1-\2]', line)
+        line = _BRACE_DOUBLE_DASH_RE.sub(r'{\1-\2}', line)
+        # Fix trailing dashes: "Label -]" -> "Label]"
+        line = _CLOSE_DOUBLE_DASH_RE.sub(r'\1\2', line)
+        line = _CLOSE_DASH_RE.sub(r'\1\2', line)
+    # Remove empty labels
+    line = _EMPTY_LABEL_RE.sub(lambda m: '[Label]' if m.group(0)[0] == '[' else '{Label}', line)
+    return f"    {line}"
+
+
+def _normalize_end_node(node: str) -> str:
+    """Rename an End node's label to the 'End: ...' format"""
+    # The id and brackets never contain ':', so a colon anywhere means the label has one
+    if ':' in node:
+        return node
+    match = _END_NODE_DEF_RE.match(node)
+    if not match:
+        return node
+    node_id, open_char, label, close_char = match.groups()
+    parts = label.split(None, 1)
+    label = f"End: {parts[1]}" if len(parts) > 1 else "End"
+    return f"{node_id}{open_char}{label}{close_char}"
+
+
+def sanitize_mermaid(code: str) -> str:
+    """Sanitize every line, dropping comments and lines that end up empty"""
+    return '\n'.join(line for line in map(_sanitize_line, code.split('\n')) if line)
+
+
+def _line_balances(code: str) -> Optional[List[List[int]]]:
+    """Per-line bracket balances from the Numba kernel for large documents, else None"""
+    if len(code) < _KERNEL_MIN_CHARS:
+        return None
+    try:
+        from agents.flowchart_kernels import line_balances
+    except ImportError:
+        return None
+    return line_balances(code)
+
+
+def check_syntax_errors(code: str) -> List[str]:
+    """Check for common syntax errors in Mermaid code"""
+    balances = _line_balances(code)
+    errors: List[str] = []
+    for i, line in enumerate(code.split('\n'), 1):
+        errors.extend(_line_errors(line.strip(), i, balances[i - 1] if balances else None))
+    return errors
+
+
+def has_syntax_errors(code: str) -> bool:
+    """check_syntax_errors without building messages, stopping at the first bad line"""
+    balances = _line_balances(code)
+    return any(
+        _line_errors(line.strip(), 0, balances[i] if balances else None)
+        for i, line in enumerate(code.split('\n'))
+    )
+
+
+def validate_mermaid(code: str) -> bool:
+    if not code or len(code.strip()) < 10:
+        return False
+    if not code.strip().startswith('flowchart'):
+        return False
+    if '-->' not in code:
+        return False
+    lines = [l for l in code.split('\n') if l.strip() and not l.strip().startswith('%%')]
+    if len(lines) < 3:
+        return False
+    node_count = sum(1 for line in lines if '-->' in line or ('[' in line and ']' in line) or ('{' in line and '}' in line))
+    if node_count < 2:
+        return False
+    return True
+
+
+def analyze_mermaid(code: str) -> Tuple[bool, List[str]]:
+    """validate_mermaid and check_syntax_errors computed in one pass over the lines"""
+    stripped_code = code.strip() if code else ""
+    if len(stripped_code) < 10 or not stripped_code.startswith('flowchart'):
+        return False, check_syntax_errors(code) if code else []
+    
+    balances = _line_balances(code)
+    errors: List[str] = []
+    has_arrow = False
+    content_lines = 0
+    node_count = 0
+    for i, line in enumerate(code.split('\n'), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if '-->' in line:
+            has_arrow = True
+        if line.startswith('%%'):
+            continue
+        content_lines += 1
+        if '-->' in line or ('[' in line and ']' in line) or ('{' in line and '}' in line):
+            node_count += 1
+        errors.extend(_line_errors(line, i, balances[i - 1] if balances else None))
+    
+    return has_arrow and content_lines >= 3 and node_count >= 2, errors
+
+
+def rewrite_mermaid(code: str) -> Tuple[str, List[str]]:
+    """
+    Repair generated Mermaid in a single walk over its lines.
+    
+    Each line is sanitized, re-fixed if it still has syntax errors, cleaned of stray
+    text after node definitions, and classified: the first header is normalized, repeated
+    standalone node definitions are dropped and End labels become "End: ...". Returns the
+    code together with the syntax errors that remain.
+    """
+    lines: List[str] = []
+    errors: List[str] = []
+    seen_ids: Set[str] = set()
+    header_done = False
+    
+    for raw_line in code.split('\n'):
+        line = _sanitize_line(raw_line)
+        if not line:
+            continue
+        
+        if line.startswith('flowchart'):
+            if not header_done:
+                match = _HEADER_RE.match(line)
+                line = match.group(1) if match else 'flowchart TD'
+                header_done = True
+            lines.append(line)
+            continue
+        
+        if _line_errors(line.strip(), 0):
+            line = _sanitize_line(_fix_syntax_line(line))
+            if not line:
+                continue
+        
+        body = _cleanup_line(line).strip()
+        if '-->' not in body:
+            match = _NODE_ID_RE.match(body)
+            if match:
+                # A set membership test plus add beats dict.setdefault here: str hashes are
+                # cached, so the second lookup is cheap and no value object is compared
+                node_id = match.group(1)
+                if node_id in seen_ids:
+                    continue
+                seen_ids.add(node_id)
+            body = _normalize_end_node(body)
+        
+        errors.extend(_line_errors(body, len(lines) + 1))
+        lines.append(f"    {body}")
+    
+    return '\n'.join(lines), errors
+
+
+def _wrap_label_if_needed(node_id: str, label: str, bracket_type: str) -> str:
+    """Wrap label in quotes if it contains special characters"""
+    # Check if label contains special characters that need quoting
+    # Special chars: parentheses, brackets, braces, colons, semicolons, commas, quotes
+    if _SPECIAL_LABEL_CHARS_RE.search(label) and not (label.startswith('"') and label.endswith('"')):
+        if bracket_type == '[':
+            return f'{node_id}["{label}"]'
+        elif bracket_type == '{':
+            return f'{node_id}{{"{label}"}}'
+        elif bracket_type == '(':
+            return f'{node_id}("{label}")'
+    # Return original format
+    if bracket_type == '[':
+        return f'{node_id}[{label}]'
+    elif bracket_type == '{':
+        return f'{node_id}{{{label}}}'
+    elif bracket_type == '(':
+        return f'{node_id}({label})'
+    return f'{node_id}[{label}]'  # fallback
+
+
+def _wrap_connection_label(left: str, label: str, right: str) -> str:
+    """Wrap connection label in quotes if it contains special characters"""
+    # Check if label contains special characters that need quoting
+    if _SPECIAL_LABEL_CHARS_RE.search(label) and not (label.startswith('"') and label.endswith('"')):
+        return f'{left} -->|"{label}"| {right}'
+    return f'{left} -->|{label}| {right}'
+
+
+def _wrap_line(line: str) -> str:
+    """Wrap the special-character labels on one line in double quotes"""
+    line_stripped = line.strip()
+    
+    # Skip empty lines and flowchart header
+    if not line_stripped or line_stripped.startswith('flowchart'):
+        return line
+    
+    # Each pattern needs its delimiters and quoting never adds any, so the regex
+    # scan is skipped when a line lacks them
+    
+    # Handle node definitions with brackets: nodeID[Label]
+    if '[' in line and ']' in line:
+        line = _WRAP_BRACKET_RE.sub(
+            lambda m: m.group(1) + _wrap_label_if_needed(m.group(2), m.group(3), '['),
+            line
+        )
+    
+    # Handle node definitions with braces: nodeID{Label}
+    if '{' in line and '}' in line:
+        line = _WRAP_BRACE_RE.sub(
+            lambda m: m.group(1) + _wrap_label_if_needed(m.group(2), m.group(3), '{'),
+            line
+        )
+    
+    # Handle node definitions with parentheses: nodeID(Label)
+    if '(' in line and ')' in line:
+        line = _WRAP_PAREN_RE.sub(
+            lambda m: m.group(1) + _wrap_label_if_needed(m.group(2), m.group(3), '('),
+            line
+        )
+    
+    # Handle labeled connections: nodeA -->|label| nodeB. The pattern runs to the end of
+    # the line, so a match from the start is the only one sub could make
+    if '|' in line and '-->' in line:
+        m = _WRAP_EDGE_LABEL_RE.match(line)
+        if m:
+            line = m.group(1) + _wrap_connection_label(m.group(2), m.group(3), m.group(4))
+    return line
+
+
+def wrap_and_analyze(code: str) -> Tuple[str, bool, List[str]]:
+    """
+    Quote special-character labels and validate the result in one walk over the lines.
+    
+    Returns the wrapped code with the same validity flag and syntax errors that
+    analyze_mermaid would report for it.
+    """
+    # Quoting never adds or removes brackets, so the balances of the input still apply
+    balances = _line_balances(code)
+    lines: List[str] = []
+    errors: List[str] = []
+    has_arrow = False
+    content_lines = 0
+    node_count = 0
+    for i, raw_line in enumerate(code.split('\n'), 1):
+        wrapped = _wrap_line(raw_line)
+        lines.append(wrapped)
+        line = wrapped.strip()
+        if not line:
+            continue
+        if '-->' in line:
+            has_arrow = True
+        if line.startswith('%%'):
+            continue
+        content_lines += 1
+        if '-->' in line or ('[' in line and ']' in line) or ('{' in line and '}' in line):
+            node_count += 1
+        errors.extend(_line_errors(line, i, balances[i - 1] if balances else None))
+    
+    wrapped_code = '\n'.join(lines)
+    stripped_code = wrapped_code.strip()
+    if len(stripped_code) < 10 or not stripped_code.startswith('flowchart'):
+        return wrapped_code, False, errors
+    return wrapped_code, has_arrow and content_lines >= 3 and node_count >= 2, errors
+
+
+def _space_line(line: str) -> str:
+    """Indent one tab-free line: none for the header, multiples of 4 (at least 4) otherwise"""
+    stripped = line.strip()
+    if not stripped or stripped.startswith('flowchart'):
+        return stripped
+    if line.startswith(' '):
+        # Round leading spaces down to a multiple of 4
+        leading_spaces = len(line) - len(line.lstrip())
+        return ' ' * ((leading_spaces // 4) * 4 or 4) + stripped
+    return '    ' + stripped
+
+
+def normalize_spacing(code: str) -> str:
+    """Ensure consistent spacing - spaces only, no tabs, consistent indentation"""
+    # Convert tabs to 4 spaces in one pass over the whole document
+    return '\n'.join(map(_space_line, code.replace('\t', '    ').split('\n')))
+
+
+def normalize_layout(code: str) -> str:
+    """Clean the first flowchart header and normalize spacing in one walk over the lines"""
+    lines: List[str] = []
+    header_done = False
+    for line in code.replace('\t', '    ').split('\n'):
+        if not header_done and line.strip().startswith('flowchart'):
+            # Keep just "flowchart TD" / "flowchart LR" etc, defaulting to TD
+            match = _HEADER_RE.match(line.strip())
+            line = match.group(1) if match else 'flowchart TD'
+            header_done = True
+        lines.append(_space_line(line))
+    return '\n'.join(lines)
+
+
+def clean_flowchart(code: str) -> Optional[str]:
+    """
+    Return indented code when it needs no label quoting or repair, else None.
+    
+    Applies when the header is already exact, there are no tabs, no characters that
+    _wrap_line would quote, no nested brackets, labeled edges are already in
+    "A -->|label| B" form and the code validates without syntax errors. Only the
+    indentation is normalized, which is all the full path would change.
+    """
+    header, _, body = code.partition('\n')
+    if not _EXACT_HEADER_RE.fullmatch(header) or '\t' in body:
+        return None
+    if _QUOTED_LABEL_CHARS_RE.search(body) or _NESTED_BRACKET_RE.search(body):
+        return None
+    if '|' in body and not all(
+        _CANONICAL_LABELED_EDGE_RE.fullmatch(line) for line in body.split('\n') if '|' in line
+    ):
+        return None
+    
+    is_valid, errors = analyze_mermaid(code)
+    if not is_valid or errors:
+        return None
+    return normalize_spacing(code)
+
+
+@functools.lru_cache(maxsize=128)
+def repair_flowchart(code: str) -> Optional[str]:
+    """
+    Turn extracted Mermaid into valid flowchart code, or None if it cannot be repaired.
+    
+    Cached because retries and repeated templates often bring back identical model output.
+    """
+    if not code.startswith('flowchart'):
+        logger.debug("Code doesn't start with 'flowchart', prepending")
+        code = f"flowchart TD\n{code}"
+    
+    clean_code = clean_flowchart(code)
+    if clean_code is not None:
+        logger.debug("Code is already clean, skipping normalization")
+        code = clean_code
+    else:
+        # Wrap labels with special characters in quotes to avoid parse errors, and check
+        # whether the code is already valid - if so, minimal processing
+        code, is_valid, syntax_errors = wrap_and_analyze(code)
+        if is_valid and not syntax_errors:
+            logger.debug("Code appears valid, applying minimal normalization only")
+            # Only normalize spacing and header - don't break valid code
+            code = normalize_layout(code)
+        else:
+            # Only apply aggressive sanitization if there are actual errors
+            logger.debug("Syntax errors detected: %s, applying fixes", syntax_errors)
+            code, syntax_errors = rewrite_mermaid(code)
+            if syntax_errors:
+                logger.debug("Syntax errors still present: %s", syntax_errors)
+    
+    return code if validate_mermaid(code) else None
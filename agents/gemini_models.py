@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import importlib
+import threading
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Any, Awaitable, Dict, Optional, Tuple, TypeVar
+
+if TYPE_CHECKING:
+    import google.generativeai as genai
+
+# GenerativeModel objects are stateless wrappers and safe to share between agents
+_MODEL_CACHE: Dict[Tuple[str, str, Optional[str]], "genai.GenerativeModel"] = {}
+_CONFIGURED_KEY: Optional[str] = None
+_LOCK = threading.Lock()
+# google.generativeai shares one grpc.aio client per process, and that client is bound to the
+# event loop it was first used on. Every generate_content_async call therefore runs on this
+# single long-lived loop; a fresh asyncio.run() loop per request breaks from the second call on.
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+T = TypeVar("T")
+
+
+@functools.lru_cache(maxsize=None)
+def _genai() -> Any:
+    """Imports google.generativeai on first use; it pulls in grpc and protobuf, which agents that never call Gemini can skip"""
+    try:
+        return importlib.import_module("google.generativeai")
+    except ImportError:
+        raise ImportError("Install google-genai: pip install google-genai")
+
+
+def get_model(api_key: str, name: str, system_instruction: Optional[str] = None) -> "genai.GenerativeModel":
+    """Configure genai once per API key and reuse one GenerativeModel per (key, model name, system instruction)"""
+    global _CONFIGURED_KEY
+    genai = _genai()
+    with _LOCK:
+        if _CONFIGURED_KEY != api_key:
+            genai.configure(api_key=api_key)
+            _CONFIGURED_KEY = api_key
+        cache_key = (api_key, name, system_instruction)
+        model = _MODEL_CACHE.get(cache_key)
+        if model is None:
+            model = _MODEL_CACHE[cache_key] = genai.GenerativeModel(name, system_instruction=system_instruction)
+        return model
+
+
+def _shared_loop() -> asyncio.AbstractEventLoop:
+    global _LOOP
+    with _LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, name="gemini-async", daemon=True).start()
+        return _LOOP
+
+
+def submit(coro: Awaitable[T]) -> "Future[T]":
+    """Schedule a coroutine on the shared Gemini loop without waiting for it"""
+    return asyncio.run_coroutine_threadsafe(coro, _shared_loop())
+
+
+def run_sync(coro: Awaitable[T]) -> T:
+    """Run a coroutine on the shared Gemini loop and block until it finishes; for synchronous entry points"""
+    loop = _shared_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError("run_sync would deadlock on the shared Gemini loop; await the coroutine instead")
+    return submit(coro).result()
+
+
+async def run_shared(coro: Awaitable[T]) -> T:
+    """Await a coroutine on the shared Gemini loop from whatever loop the caller is running"""
+    loop = _shared_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    return await asyncio.wrap_future(submit(coro))
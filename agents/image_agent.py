@@ -1,22 +1,84 @@
 from __future__ import annotations
 
 import os
+import re
+import copy
 import json
+import time
+import base64
+import logging
+import functools
+import shutil
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, Optional
-from datetime import datetime
+from typing import Any, ClassVar, Dict, List, Optional, Tuple
 
 from agents.base_agent import BaseAgent, AgentResponse, AgentStatus
+from agents.gemini_models import get_model, run_shared, run_sync
+from agents.response_cache import ResponseCache
 
 try:
-    import google.generativeai as genai
+    from rapidfuzz import fuzz
 except ImportError:
-    raise ImportError("Install google-genai: pip install google-genai")
+    fuzz = None
 
 try:
-    from dotenv import load_dotenv
+    import jiter
 except ImportError:
-    raise ImportError("Install python-dotenv: pip install python-dotenv")
+    jiter = None
+
+logger = logging.getLogger(__name__)
+
+# Outermost braces of the reply, whether or not the model wrapped them in a code fence
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+# Splits a combined style such as "professional and modern" or "cartoon, vintage"
+_STYLE_SEPARATOR_RE = re.compile(r"\s*(?:,|\band\b|&|/)\s*")
+
+# Words carrying a digit ("q1", "2024", "v2"); a fuzzy match must agree on all of them
+_NUMBER_WORD_RE = re.compile(r"\w*\d\w*")
+
+_WRITE_CHUNK = 1 << 20
+_BATCH_DONE_STATES = frozenset({"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"})
+
+# Deletes every ASCII character that is not allowed in a generated filename
+_UNSAFE_ASCII = str.maketrans("", "", "".join(c for c in map(chr, range(128)) if not (c.isalnum() or c in " -_")))
+
+
+def _json_loads(text: str) -> Any:
+    """Parse JSON with jiter when available, which also recovers a truncated final string; stdlib json otherwise"""
+    if jiter is not None:
+        return jiter.from_json(text.encode("utf-8"), partial_mode="trailing-strings", cache_mode="keys")
+    return json.loads(text)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_env() -> None:
+    """Reads .env once per process rather than once per agent"""
+    # Imported here so loading this module stays cheap; Gemini itself is imported by get_model
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        raise ImportError("Install python-dotenv: pip install python-dotenv")
+    load_dotenv()
+
+
+def _write_image(path: str, data: bytes) -> None:
+    """Writes the response buffer straight to a raw fd, in slices of one view rather than copies"""
+    view = memoryview(data)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        written = 0
+        while written < len(view):
+            written += os.write(fd, view[written:written + _WRITE_CHUNK])
+    finally:
+        os.close(fd)
+
+
+def _write_base64(path: str, data: str) -> None:
+    _write_image(path, base64.b64decode(data))
 
 
 class ImageAgent(BaseAgent):
@@ -27,6 +89,52 @@ class ImageAgent(BaseAgent):
     1. Generates a detailed JSON prompt from the user's topic
     2. Uses that prompt to generate an image with Gemini's image generation model
     """
+    RESULT_CACHE_SIZE = 128
+    PROMPT_MEMO_SIZE = 256
+    _IO_POOL = ThreadPoolExecutor(max_workers=4)  # shared by all instances for Batch Mode image writes
+    FUZZY_MATCH_THRESHOLD = 95  # token-sort score for a reworded topic to reuse an image
+    _SUPPORTED_STYLES: ClassVar[frozenset] = frozenset({
+        "realistic", "cartoon", "minimalist", "watercolor", "professional", "modern", "vintage", "abstract",
+    })
+    _SUPPORTED_ASPECT_RATIOS: ClassVar[frozenset] = frozenset({"1:1", "16:9", "9:16", "4:3", "3:4"})
+    # (label, prompt key) in the order fields appear in the final image prompt
+    _FIELDS: ClassVar[Tuple[Tuple[str, str], ...]] = (
+        ("Main Subject", "main_subject"),
+        ("Description", "detailed_description"),
+        ("Visual Elements", "visual_elements"),
+        ("Composition", "composition"),
+        ("Lighting", "lighting"),
+        ("Color Palette", "color_palette"),
+        ("Mood", "mood"),
+        ("Style", "style"),
+        ("Technical", "technical_details"),
+    )
+    # Sent as the text model's system instruction so the provider can cache this fixed prefix
+    _SYSTEM_PROMPT: ClassVar[str] = """You are an expert image prompt engineer. Your job is to take a simple topic 
+and expand it into a detailed, comprehensive image generation prompt.
+
+Generate a JSON response with the following structure:
+{
+    "main_subject": "The primary subject of the image",
+    "detailed_description": "A detailed, vivid description of what should be in the image (3-5 sentences)",
+    "visual_elements": ["element1", "element2", "element3"],
+    "composition": "How elements should be arranged (e.g., centered, rule of thirds)",
+    "lighting": "Lighting description (e.g., soft natural light, dramatic studio lighting)",
+    "color_palette": "Color scheme description (e.g., warm earth tones, vibrant and saturated)",
+    "mood": "The emotional tone (e.g., professional, playful, serene)",
+    "technical_details": "Camera/rendering details (e.g., 4K, sharp focus, depth of field)"
+}
+
+Make the prompt detailed, specific, and visually descriptive. Focus on what makes a great image."""
+    
+    # Per-request part of the prompt; the topic goes last so everything before it stays a stable prefix
+    _USER_TEMPLATE: ClassVar[str] = (
+        "Generate a detailed image prompt in JSON format. Be specific about visual details, composition, and atmosphere.\n"
+        "\n"
+        "Style: {style}\n"
+        "Aspect Ratio: {aspect_ratio}\n"
+        "Topic: {topic}"
+    )
     
     def __init__(self, config: Optional[Dict[str, Any]] = None):
         super().__init__(
@@ -36,7 +144,7 @@ class ImageAgent(BaseAgent):
         )
         
         # Load environment variables
-        load_dotenv()
+        _load_env()
         
         self.api_key = self.config.get("api_key") or os.getenv("GEMINI_API_KEY")
         self.text_model_name = self.config.get("text_model_name", "gemini-2.0-flash")
@@ -46,16 +154,53 @@ class ImageAgent(BaseAgent):
         
         if self.save_to_file:
             self.output_dir.mkdir(parents=True, exist_ok=True)
+        # Image paths are built by string concatenation on this, not with pathlib per request
+        self._output_prefix = os.path.join(os.fspath(self.output_dir), "")
+        
+        # key -> (style, aspect ratio, folded topic, prompt, image path), oldest first
+        self.result_cache_size = self.config.get("result_cache_size", self.RESULT_CACHE_SIZE)
+        self._result_cache: "OrderedDict[str, tuple]" = OrderedDict()
+        # (topic, style, aspect ratio) -> expanded prompt, so regenerating an image skips the text call
+        # The fuzzy tier is refilled from the on-disk cache on the first lookup after a restart
+        self._result_cache_warmed = False
+        self._prompt_memo: "OrderedDict[Tuple[str, str, str], Dict[str, Any]]" = OrderedDict()
+        # Prompts and image paths survive restarts here; the in-memory LRU sits in front of it
+        self.response_cache = ResponseCache(self.config.get("response_cache_path", "outputs/.response_cache.sqlite3"))
         
         if self.api_key:
-            genai.configure(api_key=self.api_key)
-            self.text_model = genai.GenerativeModel(self.text_model_name)
-            self.image_model = genai.GenerativeModel(self.image_model_name)
+            # Shared with every other agent using the same key, model and instruction
+            self.text_model = get_model(self.api_key, self.text_model_name, self._SYSTEM_PROMPT)
+            self.image_model = get_model(self.api_key, self.image_model_name)
         else:
             self.text_model = None
             self.image_model = None
     
     def process(self, request: Dict[str, Any]) -> AgentResponse:
+        return run_sync(self._process_async(request))
+    
+    def process_batch(self, requests: List[Dict[str, Any]]) -> List[AgentResponse]:
+        """
+        Runs several requests concurrently, at most ``max_concurrency`` at a time.
+        
+        With ``use_batch_mode`` set, the requests are submitted as Gemini Batch Mode jobs
+        instead, which cost less but can take hours to complete.
+        """
+        if self.config.get("use_batch_mode"):
+            return self._process_batch_mode(requests)
+        
+        async def _gather():
+            semaphore = asyncio.Semaphore(self.config.get("max_concurrency", 8))
+            async def _limited(request):
+                async with semaphore:
+                    return await self._process_async(request)
+            return await asyncio.gather(*[_limited(r) for r in requests])
+        return list(run_sync(_gather()))
+    
+    async def aprocess(self, request: Dict[str, Any]) -> AgentResponse:
+        """Awaitable from any event loop; the Gemini calls still run on the shared model loop"""
+        return await run_shared(self._process_async(request))
+    
+    async def _process_async(self, request: Dict[str, Any]) -> AgentResponse:
         """
         Process the image generation request.
         
@@ -75,39 +220,33 @@ class ImageAgent(BaseAgent):
             self.validate_request(request, ["topic"])
             
             topic = request["topic"]
-            style = request.get("style", "professional and modern")
-            aspect_ratio = request.get("aspect_ratio", "1:1")
+            style, aspect_ratio = self._request_options(request)
             filename = request.get("filename")
             
-            # Step 1: Generate detailed JSON prompt
-            print(f"[IMAGE AGENT] Step 1: Generating detailed prompt from topic...")
-            json_prompt = self._generate_detailed_prompt(topic, style, aspect_ratio)
-            print(f"[IMAGE AGENT] Generated prompt: {json.dumps(json_prompt, indent=2)}")
-            
-            # Step 2: Generate image using the detailed prompt
-            print(f"[IMAGE AGENT] Step 2: Generating image with Gemini...")
-            image_path = self._generate_image(json_prompt, filename)
-            print(f"[IMAGE AGENT] Image saved to: {image_path}")
-            
-            result = {
-                "image_path": str(image_path),
-                "prompt": json_prompt,
-                "topic": topic,
-                "style": style,
-                "aspect_ratio": aspect_ratio,
-            }
+            cache_key = ResponseCache.key("image", self.image_model_name, topic, style, aspect_ratio)
+            cached = self._cached_result(cache_key, topic, style, aspect_ratio)
+            if cached is not None:
+                json_prompt, image_path = cached
+                if filename is not None and image_path.stem != filename:
+                    image_path = Path(await asyncio.to_thread(shutil.copyfile, image_path, f"{self._output_prefix}{filename}.png"))
+                logger.info("Reusing cached image: %s", image_path)
+            else:
+                # Step 1: Generate detailed JSON prompt
+                logger.debug("Step 1: Generating detailed prompt from topic")
+                json_prompt = await self._generate_detailed_prompt(topic, style, aspect_ratio)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Generated prompt: %s", json.dumps(json_prompt, indent=2))
+                
+                # Step 2: Generate image using the detailed prompt
+                logger.debug("Step 2: Generating image with Gemini")
+                image_path = await self._generate_image(json_prompt, filename)
+                logger.info("Image saved to: %s", image_path)
+                
+                self._store_result(cache_key, topic, style, aspect_ratio, json_prompt, image_path)
+                self._persist_result(cache_key, json_prompt, image_path)
             
             self.status = AgentStatus.SUCCESS
-            return AgentResponse(
-                agent_name=self.name,
-                status=AgentStatus.SUCCESS,
-                result=result,
-                metadata={
-                    "topic": topic,
-                    "prompt_length": len(json_prompt["detailed_description"]),
-                    "model": self.image_model_name,
-                }
-            )
+            return self._success_response(topic, style, aspect_ratio, json_prompt, image_path)
             
         except Exception as exc:
             self.status = AgentStatus.ERROR
@@ -119,7 +258,247 @@ class ImageAgent(BaseAgent):
                 metadata={"request": request}
             )
     
-    def _generate_detailed_prompt(self, topic: str, style: str, aspect_ratio: str) -> Dict[str, Any]:
+    def _request_options(self, request: Dict[str, Any]) -> Tuple[str, str]:
+        """
+        Normalize and check a request's style and aspect ratio before any Gemini call.
+        
+        A style may combine supported styles ("professional and modern", "cartoon, vintage").
+        Set ``allow_any_style`` in the config to pass other styles through unchecked.
+        """
+        style = " ".join(str(request.get("style", "professional and modern")).split()).lower()
+        aspect_ratio = "".join(str(request.get("aspect_ratio", "1:1")).split())
+        
+        if not self.config.get("allow_any_style"):
+            if any(part not in self._SUPPORTED_STYLES for part in _STYLE_SEPARATOR_RE.split(style)):
+                raise ValueError(
+                    f"Unsupported style: {style!r}. Supported: {', '.join(sorted(self._SUPPORTED_STYLES))}"
+                )
+        if aspect_ratio not in self._SUPPORTED_ASPECT_RATIOS:
+            raise ValueError(
+                f"Unsupported aspect ratio: {aspect_ratio!r}. Supported: {', '.join(sorted(self._SUPPORTED_ASPECT_RATIOS))}"
+            )
+        return style, aspect_ratio
+    
+    def _success_response(self, topic: str, style: str, aspect_ratio: str,
+                          json_prompt: Dict[str, Any], image_path: Path) -> AgentResponse:
+        result = {
+            "image_path": str(image_path),
+            "prompt": json_prompt,
+            "topic": topic,
+            "style": style,
+            "aspect_ratio": aspect_ratio,
+        }
+        return AgentResponse(
+            agent_name=self.name,
+            status=AgentStatus.SUCCESS,
+            result=result,
+            metadata={
+                "topic": topic,
+                "prompt_length": len(json_prompt["detailed_description"]),
+                "model": self.image_model_name,
+            }
+        )
+    
+    def _process_batch_mode(self, requests: List[Dict[str, Any]]) -> List[AgentResponse]:
+        """
+        Generate prompts and then images for all requests as two Gemini Batch Mode jobs.
+        
+        Blocks, polling every ``batch_poll_interval`` seconds, until both jobs finish.
+        """
+        self.status = AgentStatus.PROCESSING
+        
+        try:
+            try:
+                from google import genai as genai_client  # google-genai SDK, only needed for Batch Mode
+            except ImportError:
+                raise ImportError("Install google-genai for Batch Mode: pip install google-genai")
+            if not self.api_key:
+                raise ValueError("Gemini API key required")
+            for request in requests:
+                self.validate_request(request, ["topic"])
+            
+            client = genai_client.Client(api_key=self.api_key)
+            params = [(r["topic"], *self._request_options(r)) for r in requests]
+            
+            # Requests whose reply is missing get the basic fallback prompt from _parse_prompt
+            replies = self._run_batch(
+                client, self.text_model_name, [self._prompt_request(*p) for p in params], self._SYSTEM_PROMPT
+            )
+            json_prompts = [
+                self._parse_prompt("".join(part.get("text", "") for part in parts), *p)
+                for parts, p in zip(replies, params)
+            ]
+            replies = self._run_batch(client, self.image_model_name, [self._construct_image_prompt(jp) for jp in json_prompts])
+            
+            # A finished batch hands back every image at once, so decode and write them in parallel
+            responses: List[Optional[AgentResponse]] = []
+            writes = []
+            for request, (topic, style, aspect_ratio), json_prompt, parts in zip(requests, params, json_prompts, replies):
+                inline = next((part.get("inlineData") or part.get("inline_data") for part in parts
+                               if part.get("inlineData") or part.get("inline_data")), None)
+                if inline is None:
+                    responses.append(AgentResponse(
+                        agent_name=self.name,
+                        status=AgentStatus.ERROR,
+                        result=None,
+                        error="No image data found in batch response",
+                        metadata={"request": request}
+                    ))
+                    continue
+                image_file = self._image_file(json_prompt, request.get("filename"))
+                future = self._IO_POOL.submit(_write_base64, image_file, inline["data"])
+                writes.append((len(responses), request, (topic, style, aspect_ratio), json_prompt, Path(image_file), future))
+                responses.append(None)
+            
+            for index, request, (topic, style, aspect_ratio), json_prompt, image_path, future in writes:
+                try:
+                    future.result()
+                except (OSError, ValueError) as exc:
+                    responses[index] = AgentResponse(
+                        agent_name=self.name,
+                        status=AgentStatus.ERROR,
+                        result=None,
+                        error=str(exc),
+                        metadata={"request": request}
+                    )
+                    continue
+                cache_key = ResponseCache.key("image", self.image_model_name, topic, style, aspect_ratio)
+                self._store_result(cache_key, topic, style, aspect_ratio, json_prompt, image_path)
+                self._persist_result(cache_key, json_prompt, image_path)
+                responses[index] = self._success_response(topic, style, aspect_ratio, json_prompt, image_path)
+            
+            self.status = AgentStatus.SUCCESS
+            return responses
+            
+        except Exception as exc:
+            self.status = AgentStatus.ERROR
+            return [
+                AgentResponse(
+                    agent_name=self.name,
+                    status=AgentStatus.ERROR,
+                    result=None,
+                    error=str(exc),
+                    metadata={"request": request}
+                )
+                for request in requests
+            ]
+    
+    def _run_batch(self, client: Any, model_name: str, prompts: List[str],
+                   system_instruction: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+        """Run one Batch Mode job over ``prompts`` and return each reply's content parts, in order."""
+        batch_dir = self.output_dir / ".batch"
+        batch_dir.mkdir(parents=True, exist_ok=True)
+        source = batch_dir / f"{model_name}_{int(time.time())}.jsonl"
+        with source.open("w", encoding="utf-8") as handle:
+            for index, prompt in enumerate(prompts):
+                line = {"key": f"req_{index}", "request": {"contents": [{"parts": [{"text": prompt}]}]}}
+                if system_instruction is not None:
+                    line["request"]["system_instruction"] = {"parts": [{"text": system_instruction}]}
+                handle.write(json.dumps(line) + "\n")
+        
+        uploaded = client.files.upload(file=str(source), config={"mime_type": "jsonl"})
+        job = client.batches.create(model=model_name, src=uploaded.name)
+        while job.state.name not in _BATCH_DONE_STATES:
+            time.sleep(self.config.get("batch_poll_interval", 30))
+            job = client.batches.get(name=job.name)
+        if job.state.name != "JOB_STATE_SUCCEEDED":
+            raise RuntimeError(f"Batch job {job.name} ended in state {job.state.name}")
+        
+        replies: List[List[Dict[str, Any]]] = [[] for _ in prompts]
+        for line in client.files.download(file=job.dest.file_name).decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            candidates = entry.get("response", {}).get("candidates") or []
+            if candidates:
+                replies[int(entry["key"][len("req_"):])] = candidates[0].get("content", {}).get("parts", [])
+        return replies
+    
+    def _cached_result(self, key: str, topic: str, style: str, aspect_ratio: str) -> Optional[Tuple[Dict[str, Any], Path]]:
+        """
+        Return a previously generated prompt and image for this request, if the image still exists.
+        
+        Exact repeats are found by key, first in memory and then in the on-disk cache. With
+        rapidfuzz installed, a reworded topic with the same style, aspect ratio and numbers
+        (years, quarters, versions) also matches. The prompt is returned as a copy.
+        """
+        entry = self._result_cache.get(key)
+        if entry is not None:
+            if entry[4].exists():
+                self._result_cache.move_to_end(key)
+                return copy.deepcopy(entry[3]), entry[4]
+            del self._result_cache[key]
+        
+        if fuzz is not None:
+            if not self._result_cache_warmed:
+                self._warm_result_cache()
+            folded = topic.casefold()
+            numbers = sorted(_NUMBER_WORD_RE.findall(folded))
+            best_key, best_score = None, self.FUZZY_MATCH_THRESHOLD
+            for cached_key, (cached_style, cached_ratio, cached_topic, _, image_path) in self._result_cache.items():
+                if cached_style != style or cached_ratio != aspect_ratio:
+                    continue
+                # "sales dashboard q1 2024" must never reuse the image for "... q2 2024"
+                if sorted(_NUMBER_WORD_RE.findall(cached_topic)) != numbers:
+                    continue
+                score = fuzz.token_sort_ratio(folded, cached_topic)
+                if score >= best_score and image_path.exists():
+                    best_key, best_score = cached_key, score
+            if best_key is not None:
+                self._result_cache.move_to_end(best_key)
+                return copy.deepcopy(self._result_cache[best_key][3]), self._result_cache[best_key][4]
+        
+        stored = self.response_cache.get(key)
+        if stored is None:
+            return None
+        try:
+            data = json.loads(stored)
+            json_prompt, image_path = data["prompt"], Path(data["image_path"])
+        except (json.JSONDecodeError, KeyError, TypeError):
+            return None
+        if not image_path.exists():
+            return None
+        self._store_result(key, topic, style, aspect_ratio, json_prompt, image_path)
+        return copy.deepcopy(json_prompt), image_path
+    
+    def _warm_result_cache(self) -> None:
+        """
+        Load the most recent on-disk entries for this image model into the in-memory LRU.
+        
+        Only ``result_cache_size`` rows are read, and image files are checked when a row
+        is matched rather than here, so the cost stays bounded however large the cache grows.
+        """
+        self._result_cache_warmed = True
+        for key, text in self.response_cache.recent("image", self.result_cache_size):
+            if key in self._result_cache:
+                continue
+            try:
+                data = json.loads(text)
+                if data.get("model") != self.image_model_name:
+                    continue
+                json_prompt = data["prompt"]
+                entry = (json_prompt["style"], json_prompt["aspect_ratio"], json_prompt["original_topic"].casefold(),
+                         json_prompt, Path(data["image_path"]))
+            except (json.JSONDecodeError, KeyError, TypeError, AttributeError):
+                continue
+            # Rows come newest first; each goes in front of everything already cached
+            self._result_cache[key] = entry
+            self._result_cache.move_to_end(key, last=False)
+        while len(self._result_cache) > self.result_cache_size:
+            self._result_cache.popitem(last=False)
+    
+    def _persist_result(self, key: str, json_prompt: Dict[str, Any], image_path: Path) -> None:
+        record = {"model": self.image_model_name, "prompt": json_prompt, "image_path": str(image_path)}
+        self.response_cache.put(key, json.dumps(record), "image")
+    
+    def _store_result(self, key: str, topic: str, style: str, aspect_ratio: str,
+                      json_prompt: Dict[str, Any], image_path: Path) -> None:
+        self._result_cache[key] = (style, aspect_ratio, topic.casefold(), json_prompt, image_path)
+        self._result_cache.move_to_end(key)
+        while len(self._result_cache) > self.result_cache_size:
+            self._result_cache.popitem(last=False)
+    
+    async def _generate_detailed_prompt(self, topic: str, style: str, aspect_ratio: str) -> Dict[str, Any]:
         """
         Generate a detailed JSON prompt from the topic using the text model.
         
@@ -134,40 +513,39 @@ class ImageAgent(BaseAgent):
         if not self.text_model:
             raise ValueError("Gemini API key required")
         
-        system_prompt = """You are an expert image prompt engineer. Your job is to take a simple topic 
-and expand it into a detailed, comprehensive image generation prompt.
-
-Generate a JSON response with the following structure:
-{
-    "main_subject": "The primary subject of the image",
-    "detailed_description": "A detailed, vivid description of what should be in the image (3-5 sentences)",
-    "visual_elements": ["element1", "element2", "element3"],
-    "composition": "How elements should be arranged (e.g., centered, rule of thirds)",
-    "lighting": "Lighting description (e.g., soft natural light, dramatic studio lighting)",
-    "color_palette": "Color scheme description (e.g., warm earth tones, vibrant and saturated)",
-    "mood": "The emotional tone (e.g., professional, playful, serene)",
-    "technical_details": "Camera/rendering details (e.g., 4K, sharp focus, depth of field)"
-}
-
-Make the prompt detailed, specific, and visually descriptive. Focus on what makes a great image."""
-
-        user_prompt = f"""Topic: {topic}
-Style: {style}
-Aspect Ratio: {aspect_ratio}
-
-Generate a detailed image prompt in JSON format. Be specific about visual details, composition, and atmosphere."""
-
+        key = (topic, style, aspect_ratio)
+        memo = self._prompt_memo.get(key)
+        if memo is not None:
+            self._prompt_memo.move_to_end(key)
+            # Callers add to and edit the prompt dict, so never hand out the memoized one
+            return copy.deepcopy(memo)
+        
         try:
-            response = self.text_model.generate_content(f"{system_prompt}\n\n{user_prompt}")
-            response_text = response.text.strip()
-            
-            # Extract JSON from response (handle code blocks)
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                response_text = response_text.split("```")[1].split("```")[0].strip()
-            
-            prompt_data = json.loads(response_text)
+            # Temperature 0 makes the expansion deterministic, so reusing it is the same as asking again
+            response = await self.text_model.generate_content_async(
+                self._prompt_request(topic, style, aspect_ratio), generation_config={"temperature": 0}
+            )
+            prompt_data = self._parse_prompt(response.text, topic, style, aspect_ratio)
+        except Exception as e:
+            logger.error("Error generating prompt: %s", e)
+            raise
+        
+        self._prompt_memo[key] = copy.deepcopy(prompt_data)
+        while len(self._prompt_memo) > self.PROMPT_MEMO_SIZE:
+            self._prompt_memo.popitem(last=False)
+        return prompt_data
+    
+    def _prompt_request(self, topic: str, style: str, aspect_ratio: str) -> str:
+        """Build the per-request part of the prompt; the fixed instructions are the model's system instruction."""
+        return self._USER_TEMPLATE.format_map({"topic": topic, "style": style, "aspect_ratio": aspect_ratio})
+    
+    def _parse_prompt(self, response_text: str, topic: str, style: str, aspect_ratio: str) -> Dict[str, Any]:
+        """Parse the text model's JSON reply, falling back to a basic prompt when it is malformed."""
+        try:
+            match = _JSON_OBJECT_RE.search(response_text)
+            if match is None:
+                raise ValueError("no JSON object in response")
+            prompt_data = _json_loads(match.group(0))
             
             # Add metadata
             prompt_data["style"] = style
@@ -176,9 +554,9 @@ Generate a detailed image prompt in JSON format. Be specific about visual detail
             
             return prompt_data
             
-        except json.JSONDecodeError as e:
-            print(f"[IMAGE AGENT] JSON parsing error: {e}")
-            print(f"[IMAGE AGENT] Response text: {response_text}")
+        except ValueError as e:
+            logger.warning("JSON parsing error, using basic prompt: %s", e)
+            logger.debug("Response text: %.500s", response_text)
             # Fallback to a basic prompt structure
             return {
                 "main_subject": topic,
@@ -193,11 +571,8 @@ Generate a detailed image prompt in JSON format. Be specific about visual detail
                 "aspect_ratio": aspect_ratio,
                 "original_topic": topic,
             }
-        except Exception as e:
-            print(f"[IMAGE AGENT] Error generating prompt: {e}")
-            raise
     
-    def _generate_image(self, json_prompt: Dict[str, Any], filename: Optional[str]) -> Path:
+    async def _generate_image(self, json_prompt: Dict[str, Any], filename: Optional[str]) -> Path:
         """
         Generate an image using the detailed JSON prompt.
         
@@ -214,41 +589,52 @@ Generate a detailed image prompt in JSON format. Be specific about visual detail
         # Construct the final image prompt from JSON
         image_prompt = self._construct_image_prompt(json_prompt)
         
-        print(f"[IMAGE AGENT] Final prompt for image generation:")
-        print(f"[IMAGE AGENT] {image_prompt}")
+        logger.debug("Final prompt for image generation:\n%s", image_prompt)
         
         try:
             # Generate image with Gemini
-            response = self.image_model.generate_content(image_prompt)
+            response = await self.image_model.generate_content_async(image_prompt)
             
             # Save the image
-            if filename is None:
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                safe_topic = "".join(c for c in json_prompt["original_topic"][:30] if c.isalnum() or c in (' ', '-', '_')).strip()
-                safe_topic = safe_topic.replace(' ', '_')
-                filename = f"image_{safe_topic}_{timestamp}"
+            image_file = self._image_file(json_prompt, filename)
             
-            image_path = self.output_dir / f"{filename}.png"
-            
-            # Extract and save image from response
-            if hasattr(response, '_result'):
-                # Check if the response contains image data
-                for candidate in response._result.candidates:
-                    for part in candidate.content.parts:
-                        if hasattr(part, 'inline_data'):
-                            image_data = part.inline_data.data
-                            image_path.write_bytes(image_data)
-                            return image_path
+            # Extract and save image from response. The image is the first part in practice,
+            # so fetch it directly and only walk every candidate's parts when that path is missing.
+            try:
+                image_data = response._result.candidates[0].content.parts[0].inline_data.data
+            except (AttributeError, IndexError):
+                image_data = next(
+                    (part.inline_data.data
+                     for candidate in getattr(getattr(response, '_result', None), 'candidates', ())
+                     for part in candidate.content.parts if hasattr(part, 'inline_data')),
+                    None,
+                )
+            if image_data is not None:
+                await asyncio.to_thread(_write_image, image_file, image_data)
+                return Path(image_file)
             
             # If no image data found in response, try to extract it differently
             # This is a fallback in case the API response structure is different
             raise ValueError("No image data found in response. The model may not support image generation yet.")
             
         except Exception as e:
-            print(f"[IMAGE AGENT] Error during image generation: {e}")
-            print(f"[IMAGE AGENT] Note: Make sure you have access to the image generation model")
+            logger.error("Error during image generation (check access to the image generation model): %s", e)
             raise
     
+    def _image_file(self, json_prompt: Dict[str, Any], filename: Optional[str]) -> str:
+        """Output path for an image, derived from the topic and time unless a filename is given."""
+        if filename is None:
+            timestamp = time.strftime("%Y%m%d_%H%M%S")
+            safe_topic = json_prompt["original_topic"][:30]
+            if safe_topic.isascii():
+                safe_topic = safe_topic.translate(_UNSAFE_ASCII)
+            else:
+                # Non-ASCII letters and digits are kept, which a 128-entry table cannot express
+                safe_topic = "".join(c for c in safe_topic if c.isalnum() or c in (' ', '-', '_'))
+            safe_topic = safe_topic.strip().replace(' ', '_')
+            filename = f"image_{safe_topic}_{timestamp}"
+        return f"{self._output_prefix}{filename}.png"
+    
     def _construct_image_prompt(self, json_prompt: Dict[str, Any]) -> str:
         """
         Construct a comprehensive text prompt from the JSON structure.
@@ -260,24 +646,10 @@ Generate a detailed image prompt in JSON format. Be specific about visual detail
             Formatted text prompt for image generation
         """
         parts = [
-            f"Main Subject: {json_prompt.get('main_subject', '')}",
-            f"\nDescription: {json_prompt.get('detailed_description', '')}",
+            f"{label}: {', '.join(value) if isinstance(value, list) else value}"
+            for label, key in self._FIELDS if (value := json_prompt.get(key))
         ]
-        
-        if json_prompt.get('visual_elements'):
-            elements = ", ".join(json_prompt['visual_elements'])
-            parts.append(f"\nVisual Elements: {elements}")
-        
-        parts.extend([
-            f"\nComposition: {json_prompt.get('composition', '')}",
-            f"\nLighting: {json_prompt.get('lighting', '')}",
-            f"\nColor Palette: {json_prompt.get('color_palette', '')}",
-            f"\nMood: {json_prompt.get('mood', '')}",
-            f"\nStyle: {json_prompt.get('style', '')}",
-            f"\nTechnical: {json_prompt.get('technical_details', '')}",
-        ])
-        
-        return " ".join(parts)
+        return "\n".join(parts)
     
     def get_capabilities(self) -> Dict[str, Any]:
         """Get agent capabilities and configuration."""
@@ -287,17 +659,8 @@ Generate a detailed image prompt in JSON format. Be specific about visual detail
             "image_model": self.image_model_name,
             "has_api_key": bool(self.api_key),
             "output_directory": str(self.output_dir),
-            "supported_styles": [
-                "realistic",
-                "cartoon",
-                "minimalist",
-                "watercolor",
-                "professional",
-                "modern",
-                "vintage",
-                "abstract",
-            ],
-            "supported_aspect_ratios": ["1:1", "16:9", "9:16", "4:3", "3:4"],
+            "supported_styles": sorted(self._SUPPORTED_STYLES),
+            "supported_aspect_ratios": sorted(self._SUPPORTED_ASPECT_RATIOS),
         })
         return base_caps
 
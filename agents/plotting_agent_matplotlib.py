@@ -22,6 +22,15 @@ try:
 except ImportError:
     raise ImportError("Install google-genai: pip install google-genai")
 
+# "Q1 - North: 120, South: 90, East: 75, West: 60", one match per quarter
+_QUARTERLY_LINE_RE = re.compile(r'Q(\d+)\s*[-–]\s*(.+?)(?=Q\d+|$)', re.IGNORECASE | re.DOTALL)
+_REGION_VALUE_RE = re.compile(r'(\w+):\s*(\d+)')
+# "Category: value" or "Category - value"
+_KV_RE = re.compile(r'([A-Za-z0-9\s]+)[\s:,-]+(\d+(?:\.\d+)?)')
+_TITLE_RE = re.compile(r'[Tt]itle[:\s]+["\']?([^"\'\n]+)["\']?')
+# Per detected chart type: an instruction introduced by a dash or colon, e.g. "- bar chart"
+_INSTRUCTION_RES = {dt: re.compile(r'[-–:]\s*' + dt + r'\s+chart') for dt in ('bar', 'line', 'pie')}
+
 
 class PlottingAgentMatplotlib(BaseAgent):
     def __init__(self, config: Optional[Dict[str, Any]] = None):
@@ -88,10 +97,7 @@ class PlottingAgentMatplotlib(BaseAgent):
                 # This usually indicates they want separate charts
                 if not wants_separate and len(detected_types) > 1:
                     # Count how many times "chart" appears with instructions (colon or dash before it)
-                    instruction_patterns = [
-                        r'[-–:]\s*' + dt + r'\s+chart' for dt in detected_types
-                    ]
-                    if sum(1 for pattern in instruction_patterns if re.search(pattern, topic_lower)) >= len(detected_types):
+                    if sum(1 for dt in detected_types if _INSTRUCTION_RES[dt].search(topic_lower)) >= len(detected_types):
                         wants_separate = True
                         print(f"[PLOTTING] Detected separate instructions for each chart type - creating separate charts")
                 
@@ -268,16 +274,13 @@ class PlottingAgentMatplotlib(BaseAgent):
             text_normalized = text.replace(';', '\n')
             
             # Check if it's quarterly data with regions - match all regions in one line
-            # Pattern: "Q1 - North: 120, South: 90, East: 75, West: 60"
-            quarterly_line_pattern = r'Q(\d+)\s*[-–]\s*(.+?)(?=Q\d+|$)'
-            quarterly_lines = re.findall(quarterly_line_pattern, text_normalized, re.IGNORECASE | re.DOTALL)
+            quarterly_lines = _QUARTERLY_LINE_RE.findall(text_normalized)
             
             if quarterly_lines:
                 region_data = {}
                 for quarter_num, region_values_str in quarterly_lines:
                     # Extract all "Region: value" pairs from this line
-                    region_value_pattern = r'(\w+):\s*(\d+)'
-                    region_matches = re.findall(region_value_pattern, region_values_str)
+                    region_matches = _REGION_VALUE_RE.findall(region_values_str)
                     
                     for region, value in region_matches:
                         region = region.strip().title()
@@ -297,7 +300,7 @@ class PlottingAgentMatplotlib(BaseAgent):
                         values.append(data_points[-1][1])  # Use last quarter's data
                     
                     if labels and values:
-                        title_match = re.search(r'[Tt]itle[:\s]+["\']?([^"\'\n]+)["\']?', text)
+                        title_match = _TITLE_RE.search(text)
                         title = title_match.group(1).strip() if title_match else "Regional Revenue Performance"
                         
                         return {
@@ -308,8 +311,7 @@ class PlottingAgentMatplotlib(BaseAgent):
                         }
             
             # Pattern: "Category: value" or "Category - value"
-            pattern = r'([A-Za-z0-9\s]+)[\s:,-]+(\d+(?:\.\d+)?)'
-            matches = re.findall(pattern, text)
+            matches = _KV_RE.findall(text)
             
             if matches and len(matches) >= 2:
                 labels = []
@@ -326,7 +328,7 @@ class PlottingAgentMatplotlib(BaseAgent):
                 
                 if labels and values:
                     # Extract title if present
-                    title_match = re.search(r'[Tt]itle[:\s]+["\']?([^"\'\n]+)["\']?', text)
+                    title_match = _TITLE_RE.search(text)
                     title = title_match.group(1).strip() if title_match else "Chart"
                     
                     return {
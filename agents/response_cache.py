@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import re
+import time
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+class ResponseCache:
+    """
+    Persistent cache of Gemini response texts, stored in SQLite.
+
+    Keys are built from the request fields that determine the output. Text fields are
+    canonicalized (case-folded, whitespace collapsed) so a retried prompt that differs
+    only in spacing or capitalization still hits the cache. Each row records when it was
+    written, so callers that need fresh results can pass ``max_age`` to ``get``.
+    """
+
+    DEFAULT_MAX_AGE = 7 * 86400  # seconds; shared bound for reusing generated drafts
+
+    def __init__(self, path: Any):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, namespace TEXT, text TEXT, created_at INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(responses)")}
+        if "created_at" not in columns:
+            # Caches written before rows were timestamped; those rows count as stale
+            self._conn.execute("ALTER TABLE responses ADD COLUMN created_at INTEGER NOT NULL DEFAULT 0")
+        self._conn.commit()
+
+    @staticmethod
+    def key(namespace: str, *parts: Any) -> str:
+        canonical = [namespace] + [_WHITESPACE_RE.sub(" ", str(part)).strip().casefold() for part in parts]
+        return hashlib.sha256("\x1f".join(canonical).encode("utf-8")).hexdigest()
+
+    def get(self, key: str, max_age: Optional[int] = None) -> Optional[str]:
+        """Return the cached text, ignoring rows older than ``max_age`` seconds when given"""
+        with self._lock:
+            if max_age is None:
+                row = self._conn.execute("SELECT text FROM responses WHERE key = ?", (key,)).fetchone()
+            else:
+                row = self._conn.execute(
+                    "SELECT text FROM responses WHERE key = ? AND created_at >= ?",
+                    (key, int(time.time()) - max_age),
+                ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, text: str, namespace: str = "") -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, namespace, text, created_at) VALUES (?, ?, ?, ?)",
+                (key, namespace, text, int(time.time())),
+            )
+            self._conn.commit()
+
+    def recent(self, namespace: str, limit: int) -> List[Tuple[str, str]]:
+        """Return up to ``limit`` (key, text) rows from ``namespace``, newest first"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT key, text FROM responses WHERE namespace = ? ORDER BY created_at DESC, rowid DESC LIMIT ?",
+                (namespace, limit),
+            ).fetchall()